@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""Offline benchmarks for our hot paths.
+
+    python bench.py [benchmark ...] > bench_output.txt
+
+Nothing here touches the network: GH is faked (like in the tests) and
+Fiesta calls do nothing. Mongo is used for real, in BENCH_DB, which is
+dropped when we're done. Results are printed as JSON so runs on
+different commits can be compared; times are in seconds per call.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import platform
+import StringIO
+import subprocess
+import sys
+import time
+import timeit
+import urlparse
+
+import coding
+import db
+import github
+import settings
+import sign
+# Our own invite threads would race with the invite drain benchmark.
+settings.invite_thread = False
+import worker
+import www
+
+
+BENCH_DB = "gitlists_bench"
+REPEAT = 5
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def measure(fn, number, repeat=None):
+    """Time `fn()`, called `number` times in a row, `repeat` times over.
+    """
+    repeat = repeat or REPEAT
+    return summarize(timeit.repeat(fn, repeat=repeat, number=number), number)
+
+
+def summarize(times, number):
+    """Results for `times`, each the time `number` calls took.
+    """
+    times = sorted(t / number for t in times)
+    return {"number": number,
+            "repeat": len(times),
+            "best": times[0],
+            "median": times[len(times) // 2],
+            "per_second": times[0] and 1 / times[0] or None}
+
+
+# A fake GH, serving pre-encoded JSON bodies by path
+GITHUB = {}
+PER_PAGE = 100
+
+
+class Response(StringIO.StringIO):
+
+    def __init__(self, body, headers):
+        StringIO.StringIO.__init__(self, body)
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return 200
+
+
+def fake_urlopen(url, params=None, headers=None):
+    _, _, path, query, _ = urlparse.urlsplit(url)
+    page = int(urlparse.parse_qs(query).get("page", ["1"])[0])
+    response_headers = {"x-ratelimit-remaining": "5000",
+                        "x-ratelimit-reset": str(int(time.time()) + 3600)}
+    body = GITHUB[path]
+    if isinstance(body, list):
+        response_headers["link"] = '<%s&page=%d>; rel="last"' % (url,
+                                                                 len(body))
+        body = body[page - 1]
+    return Response(body, response_headers)
+
+
+def serve(path, data):
+    """Have our fake GH serve `data` at `path`, paginated if it's a list.
+    """
+    if isinstance(data, list) and len(data) > PER_PAGE:
+        GITHUB[path] = [json.dumps(data[i:i + PER_PAGE])
+                        for i in range(0, len(data), PER_PAGE)]
+    else:
+        GITHUB[path] = json.dumps(data)
+
+
+class NullGroup(object):
+
+    def __init__(self, id="bench"):
+        self.id = id
+
+    def add_application(self, *args, **kwargs):
+        pass
+
+    def add_member(self, *args, **kwargs):
+        pass
+
+
+class NullFiesta(object):
+
+    def __init__(self):
+        self.groups = 0
+
+    def create_group(self, **kwargs):
+        self.groups += 1
+        return NullGroup("bench%d" % self.groups)
+
+
+def repo_list(n, prefix="repo"):
+    return [{"name": "%s%d" % (prefix, i),
+             "description": "Repo number %d, for benchmarking" % i}
+            for i in range(n)]
+
+
+def reset_db():
+    for c in db.db.collection_names():
+        if not c.startswith("system."):
+            db.db.drop_collection(c)
+    db.create_indexes()
+    db.memo_cache.clear()
+
+
+@benchmark
+def signing():
+    message = "create" + "a" * 40
+    sig = sign.sign(message)
+    key = settings.message_key
+    # Keying a new HMAC for every signature, for comparison.
+    yield "hmac_new", measure(
+        lambda: hmac.new(key, message, hashlib.sha1).digest(), 10000)
+    yield "digest", measure(lambda: sign.digest(message), 10000)
+    yield "sign", measure(lambda: sign.sign(message), 10000)
+    yield "sign_many_5", measure(lambda: sign.sign_many([message] * 5), 2000)
+    yield "check_sig", measure(lambda: sign.check_sig(message, sig, 3600),
+                               10000)
+    yield "no_time_32", measure(lambda: sign.no_time_32(message), 10000)
+
+
+@benchmark
+def encoding():
+    now = int(time.time())
+    created = coding.urlenc_int(now)
+    big = coding.urlenc_int(2 ** 600)
+    raw = os.urandom(20)
+    b32, b64 = coding.b32enc(raw), coding.b64enc(raw)
+    yield "urlenc_int", measure(lambda: coding.urlenc_int(now), 10000)
+    yield "urldec_int", measure(lambda: coding.urldec_int(created), 10000)
+    yield "urldec_int_100", measure(lambda: coding.urldec_int(big), 1000)
+    yield "b32enc", measure(lambda: coding.b32enc(raw), 10000)
+    yield "b32dec", measure(lambda: coding.b32dec(b32), 10000)
+    yield "b64enc", measure(lambda: coding.b64enc(raw), 10000)
+    yield "b64dec", measure(lambda: coding.b64dec(b64), 10000)
+
+
+@benchmark
+def make_request():
+    reset_db()
+    serve("/user", {"login": "bench", "email": "bench@example.com"})
+    serve("/orgs/bench/repos", repo_list(100))
+    github.make_request("/orgs/bench/repos", memoize=True)
+
+    def db_hit():
+        db.memo_cache.clear()
+        github.make_request("/orgs/bench/repos", memoize=True)
+
+    yield "miss", measure(lambda: github.make_request("/user"), 200)
+    yield "memo_hit", measure(
+        lambda: github.make_request("/orgs/bench/repos", memoize=True), 1000)
+    yield "memo_hit_db", measure(db_hit, 200)
+
+
+@benchmark
+def repo_create():
+    """Creating a list: finding its audience, queueing (held) invites for
+    them, creating the group and releasing the invites.
+    """
+    www.fiesta_api = NullFiesta()
+    for n in [10, 1000, 50000]:
+        reset_db()
+        serve("/user", {"login": "bench", "email": "bench@example.com"})
+        serve("/user/repos", repo_list(1, "test"))
+        logins = [{"login": "user%d" % i} for i in range(n)]
+        serve("/repos/bench/test0/collaborators", logins[:n // 10])
+        serve("/repos/bench/test0/contributors", logins[:n // 2])
+        serve("/repos/bench/test0/watchers", logins)
+        serve("/repos/bench/test0/forks",
+              [{"owner": l} for l in logins[n // 4:n // 2]])
+
+        def create():
+            db.db.invites.remove()
+            job = db.claim_job(db.new_job("bench", repo="test0", org=None),
+                               www.JOB_LEASE)
+            start = timeit.default_timer()
+            www.repo_create(job, "test0")
+            return timeit.default_timer() - start
+
+        # Fill the memo first, like for any list after the first.
+        create()
+        yield str(n), summarize([create() for _ in
+                                 range(n < 50000 and REPEAT or 1)], 1)
+
+
+@benchmark
+def invite_drain():
+    """Sending queued invites (to saved users), in invites per second.
+    """
+    n = 2000
+    worker.fiesta_group = lambda group_id: NullGroup()
+    sender = worker.SendInvites()
+
+    def drain():
+        reset_db()
+        usernames = ["user%d" % i for i in range(n // 2)]
+        db.save_users(dict((u, {"email": u + "@example.com"})
+                           for u in usernames))
+        # Two lists apiece, so each user's invites get coalesced.
+        for group in ["g1", "g2"]:
+            db.pending_invites("test", "https://github.com/bench/test",
+                               "bench", usernames, group)
+        start = timeit.default_timer()
+        while sender.send_batch():
+            pass
+        while db.db.invites.count():
+            time.sleep(0.001)
+        return timeit.default_timer() - start
+
+    yield str(n), summarize([drain() for _ in range(REPEAT)], n)
+
+
+@benchmark
+def render_index():
+    user = {"login": "bench", "email": "bench@example.com"}
+    orgs = [{"login": "org%d" % i} for i in range(10)]
+    for n in [1000, 5000]:
+        repos = repo_list(n)
+        org_repos = [repo_list(n // 10, org["login"]) for org in orgs]
+
+        versioned = (repos, "v1")
+        org_versioned = [(r, "v1") for r in org_repos]
+
+        def render():
+            with www.app.test_request_context("/"):
+                www.render_index(user, versioned, orgs, org_versioned)
+
+        def render_cold():
+            www.fragments.clear()
+            render()
+        yield str(n), measure(render_cold, 10)
+        yield "%d_cached" % n, measure(render, 10)
+
+
+def commit():
+    try:
+        git = subprocess.Popen(["git", "rev-parse", "HEAD"],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return git.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def run(names=None):
+    db.db = db.db.connection[BENCH_DB]
+    github.urlopen = fake_urlopen
+    github._local.token = "bench"
+
+    results = {}
+    try:
+        for fn in BENCHMARKS:
+            if names and fn.__name__ not in names:
+                continue
+            results[fn.__name__] = dict(fn())
+    finally:
+        db.db.connection.drop_database(BENCH_DB)
+    return {"commit": commit(),
+            "python": platform.python_version(),
+            "time": time.time(),
+            "results": results}
+
+
+if __name__ == '__main__':
+    print json.dumps(run(sys.argv[1:]), indent=2, sort_keys=True)
@@ -0,0 +1,66 @@
+"""In-process caching."""
+
+import collections
+import threading
+import time
+
+
+class LRU(object):
+    """A thread-safe LRU cache bounded by item count and total size.
+
+    Entries can also be given a time-to-live (in seconds).
+    """
+
+    def __init__(self, max_items, max_bytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry and entry[2] is not None and entry[2] < time.time():
+                self.bytes -= entry[1]
+                entry = None
+            if not entry:
+                self.stats["misses"] += 1
+                return default
+            self._items[key] = entry
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, value, size=1, ttl=None):
+        if size > self.max_bytes:
+            self.pop(key)
+            return
+        expires = ttl is not None and time.time() + ttl or None
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old:
+                self.bytes -= old[1]
+            self._items[key] = (value, size, expires)
+            self.bytes += size
+            while len(self._items) > self.max_items or \
+                    self.bytes > self.max_bytes:
+                _, (_, evicted, _) = self._items.popitem(last=False)
+                self.bytes -= evicted
+                self.stats["evictions"] += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry:
+                self.bytes -= entry[1]
+                return entry[0]
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.bytes = 0
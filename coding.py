@@ -8,6 +8,7 @@ import errors
 
 CHARS = string.digits + string.ascii_letters + "-_"
 RADIX = len(CHARS)
+VALUES = dict((c, i) for (i, c) in enumerate(CHARS))
 
 
 def urlenc_int(i):
@@ -23,11 +24,11 @@ def urlenc_int(i):
 
 def urldec_int(s):
     result = 0
-    while len(s):
-        result *= RADIX
-        c = s[0]
-        result += CHARS.index(c)
-        s = s[1:]
+    for c in s:
+        try:
+            result = result * RADIX + VALUES[c]
+        except KeyError:
+            raise ValueError("bad char for urldec %r" % c)
     return result
 
 
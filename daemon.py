@@ -4,11 +4,35 @@ import atexit
 import errno
 import logging
 import logging.handlers
+import fcntl
 import os
-from signal import SIGTERM
+import signal
+from signal import SIGHUP, SIGKILL, SIGTERM
+import socket
 import sys
+import threading
 import time
 
+import werkzeug.serving
+
+import pool
+
+
+# How long (in seconds) stopping workers get to finish what they're doing.
+DRAIN_TIMEOUT = 30
+
+# A restarted master finds the listening socket it inherited, and the
+# master it's taking over from, in these environment variables.
+LISTEN_FD = "GITLISTS_LISTEN_FD"
+PREVIOUS_MASTER = "GITLISTS_PREVIOUS_MASTER"
+
+
+def inherited_fd():
+    """The listening socket our previous generation handed us, if any.
+    """
+    fd = os.environ.get(LISTEN_FD)
+    return fd and int(fd) or None
+
 
 def go(daemon):
     if len(sys.argv) > 1:
@@ -35,9 +59,16 @@ class Daemon:
 
     Usage: subclass the Daemon class and override the run() method
     """
+    # Whether restart() can hand over to a new generation (on SIGHUP)
+    # rather than stopping and starting.
+    graceful = False
+
     def __init__(self, pidfile, logfile=None):
         self.pidfile = pidfile
         self.logfile = logfile
+        # How to start us again, even after we've changed directory.
+        self.argv = [sys.executable, os.path.abspath(sys.argv[0]),
+                     "start"] + sys.argv[2:]
 
     def daemonize(self):
         """
@@ -81,7 +112,9 @@ class Daemon:
                     raise
         os.close(null)
 
-        # write pidfile
+        self.writepid()
+
+    def writepid(self):
         atexit.register(self.delpid)
         pid = str(os.getpid())
         file(self.pidfile,'w+').write("%s\n" % pid)
@@ -98,12 +131,32 @@ class Daemon:
         log.addHandler(handler)
 
     def delpid(self):
-        os.remove(self.pidfile)
+        # After a graceful restart the pidfile is our successor's.
+        if self.getpid() == os.getpid():
+            os.remove(self.pidfile)
+
+    def getpid(self):
+        try:
+            pf = file(self.pidfile,'r')
+            pid = int(pf.read().strip())
+            pf.close()
+        except (IOError, ValueError):
+            pid = None
+        return pid
 
     def start(self):
         """
         Start the daemon
         """
+        if inherited_fd() is not None:
+            # We're a new generation, exec'd by the (already daemonized)
+            # master we're replacing.
+            self.writepid()
+            if self.logfile:
+                self.setup_logging()
+            self.run()
+            return
+
         # Check for a pidfile to see if the daemon already runs
         try:
             pf = file(self.pidfile,'r')
@@ -184,6 +237,13 @@ class Daemon:
         """
         Restart the daemon
         """
+        pid = self.getpid()
+        if self.graceful and pid:
+            try:
+                os.kill(pid, SIGHUP)
+                return
+            except OSError:
+                pass
         self.stop()
         self.start()
 
@@ -193,3 +253,216 @@ class Daemon:
         will be called after the process has been daemonized by
         start() or restart().
         """
+
+
+class PooledWSGIServer(werkzeug.serving.BaseWSGIServer):
+    """A WSGI server that handles requests on a pool of `threads` threads.
+
+    When every thread is busy, the connection we've just accepted waits
+    for one to be free, and we don't accept any more until it's handed
+    off. So a busy process holds at most one connection it can't handle
+    yet, and leaves the rest on a shared socket to the others. Pass `fd`
+    to serve from an inherited listening socket.
+    """
+
+    def __init__(self, host, port, app, threads=1, fd=None):
+        werkzeug.serving.BaseWSGIServer.__init__(self, host,
+                                                 fd is None and port or 0, app)
+        if fd is not None:
+            self.socket.close()
+            raw = socket.fromfd(fd, self.address_family, socket.SOCK_STREAM)
+            os.close(fd)
+            self.socket = socket.socket(_sock=raw)
+            self.server_address = self.socket.getsockname()
+            self.port = self.server_address[1]
+        self.threads = threads
+        self.pool = pool.Pool(threads)
+        self.busy = 0
+        self.changed = threading.Condition()
+
+    def process_request(self, request, client_address):
+        with self.changed:
+            while self.busy >= self.threads:
+                self.changed.wait()
+            self.busy += 1
+        self.pool.submit(self.handle, request, client_address)
+
+    def handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self.changed:
+                self.busy -= 1
+                self.changed.notifyAll()
+
+    def serve_until_stopped(self):
+        """Serve until we get a SIGTERM, then stop accepting connections.
+        """
+        stopping = []
+        signal.signal(SIGTERM, lambda signum, frame: stopping.append(signum))
+        serving = threading.Thread(target=self.serve_forever)
+        serving.daemon = True
+        serving.start()
+        while not stopping:
+            # Signals interrupt this, so we don't actually wait long.
+            time.sleep(1)
+        self.shutdown()
+
+    def drain(self, timeout):
+        """Wait (up to `timeout` seconds) for the requests we're handling.
+
+        Returns whether they all finished.
+        """
+        deadline = time.time() + timeout
+        with self.changed:
+            while self.busy and time.time() < deadline:
+                self.changed.wait(deadline - time.time())
+            return not self.busy
+
+
+class Prefork(object):
+    """Runs `serve(number)` in `workers` child processes.
+
+    Workers are numbered from 0, so callers can give one of them jobs
+    that should only run once. A worker that dies is replaced by one
+    with the same number.
+
+    SIGTERM stops the workers, giving them `drain_timeout` seconds to
+    finish what they're doing before they're killed. SIGHUP starts a new
+    master (running `argv`) and hands it our listening socket `fd`; once
+    its workers are up it SIGTERMs us.
+    """
+
+    # Seconds to wait before replacing a worker, so one that can't start
+    # doesn't have us forking as fast as we can.
+    RESPAWN_DELAY = 1
+
+    def __init__(self, workers, serve, drain_timeout=DRAIN_TIMEOUT, fd=None,
+                 argv=None):
+        self.workers = workers
+        self.serve = serve
+        self.drain_timeout = drain_timeout
+        self.fd = fd
+        self.argv = argv
+        self.children = {}
+        self.stopping = False
+        self.restarting = False
+
+    def spawn(self, number):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = number
+            return
+
+        # The worker: it mustn't run our atexit handlers (or come back
+        # here), so it leaves with os._exit.
+        signal.signal(SIGTERM, signal.SIG_DFL)
+        signal.signal(SIGHUP, signal.SIG_DFL)
+        status = 0
+        try:
+            self.serve(number)
+        except:
+            logging.exception("Worker %d failed" % number)
+            status = 1
+        os._exit(status)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def restart(self, signum=None, frame=None):
+        self.restarting = True
+
+    def reexec(self):
+        """Start a new master, running whatever code is deployed now.
+        """
+        if self.fd is None or not self.argv:
+            logging.error("Can't restart without a socket to hand over")
+            return
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        env = dict(os.environ)
+        env[LISTEN_FD] = str(self.fd)
+        env[PREVIOUS_MASTER] = str(os.getpid())
+        if not os.fork():
+            try:
+                os.execve(self.argv[0], self.argv, env)
+            finally:
+                os._exit(1)
+
+    def reap(self):
+        """Forget about workers that have exited, returning their numbers.
+        """
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return exited
+                raise
+            if not pid:
+                return exited
+            number = self.children.pop(pid, None)
+            if number is not None:
+                exited.append((number, pid, status))
+
+    def run(self):
+        signal.signal(SIGTERM, self.stop)
+        signal.signal(SIGHUP, self.restart)
+        for number in range(self.workers):
+            self.spawn(number)
+
+        previous = os.environ.pop(PREVIOUS_MASTER, None)
+        os.environ.pop(LISTEN_FD, None)
+        if previous:
+            # We're up, so the master we're replacing can stop.
+            try:
+                os.kill(int(previous), SIGTERM)
+            except OSError:
+                pass
+
+        while not self.stopping:
+            if self.restarting:
+                self.restarting = False
+                self.reexec()
+            exited = self.reap()
+            for (number, pid, status) in exited:
+                logging.error("Worker %d (pid %d) exited with status %d" %
+                              (number, pid, status))
+            if exited:
+                time.sleep(self.RESPAWN_DELAY)
+                if not self.stopping:
+                    for (number, _, _) in exited:
+                        self.spawn(number)
+            else:
+                # Signals interrupt this, too.
+                time.sleep(0.5)
+        self.drain()
+        sys.exit(0)
+
+    def drain(self):
+        """Stop our workers, killing any that take longer than drain_timeout.
+        """
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, SIGTERM)
+            except OSError:
+                pass
+        deadline = time.time() + self.drain_timeout
+        while self.children and time.time() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        for pid in self.children.keys():
+            logging.error("Worker %d (pid %d) didn't stop in time" %
+                          (self.children[pid], pid))
+            try:
+                os.kill(pid, SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.children = {}
@@ -1,6 +1,18 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import bson
+import decorator
 from pymongo import Connection
 import pymongo.errors
 
+import cache
+import coding
+import errors
+import metrics
 import settings
 
 
@@ -10,57 +22,535 @@ except:
     db = Connection(replicaset="fiesta", tz_aware=True)["gitlists"]
 
 
+# The in-process tier of the memo cache, in front of the memo collection.
+MEMO_CACHE_ITEMS = 1000
+MEMO_CACHE_BYTES = 16 * 1024 * 1024
+memo_cache = cache.LRU(MEMO_CACHE_ITEMS, MEMO_CACHE_BYTES)
+memo_stats = {"hits": 0, "misses": 0}
+
+# Size (in bytes) of the capped collection we use to wake up invite
+# workers in other processes.
+SIGNALS_SIZE = 1024 * 1024
+
+
+# Calls that take longer than this (in seconds) are slow. With
+# `explain_slow_queries = True` in settings we log explain() output for
+# the queries they made.
+SLOW_CALL = 0.1
+_watched = threading.local()
+
+
+@decorator.decorator
+def instrumented(fn, *args, **kwargs):
+    """Count calls to `fn`, and how long they take.
+    """
+    outer = getattr(_watched, "cursors", None)
+    _watched.cursors = []
+    start = time.time()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        metrics.inc("db_calls", fn=fn.__name__)
+        metrics.observe("db_seconds", elapsed, fn=fn.__name__)
+        if elapsed > SLOW_CALL and \
+                getattr(settings, "explain_slow_queries", False):
+            for cursor in _watched.cursors:
+                logging.warning("Slow call to db.%s (%.3fs): %r",
+                                fn.__name__, elapsed, cursor.explain())
+        _watched.cursors = outer
+
+
+def watch(cursor):
+    """Explain `cursor` if the call it's part of turns out to be slow.
+    """
+    if getattr(_watched, "cursors", None) is not None:
+        _watched.cursors.append(cursor)
+    return cursor
+
+
+@instrumented
+def create_collections():
+    try:
+        db.create_collection("signals", capped=True, size=SIGNALS_SIZE)
+        # Tailable cursors die on an empty collection.
+        db.signals.insert({"t": time.time()}, safe=True)
+    except pymongo.errors.CollectionInvalid:
+        pass
+
+
+@instrumented
 def create_indexes():
+    create_collections()
     db.memo.create_index("u")
+    db.memo.create_index("x", expireAfterSeconds=0)
+    # Memo docs from before memo keys, keyed by the full URL (access
+    # token and all) and without an expiry.
+    db.memo.remove({"u": {"$regex": "^https?://"}})
     db.lists.create_index([("name", 1), ("username", 1)])
+    db.lists.create_index("group_id")
+    db.jobs.create_index([("owner", 1), ("repo", 1)])
+    # Claims take the invites whose leases ran out first, in (lease, _id)
+    # order, which this index serves along with the range on lease.
+    db.invites.create_index([("lease", 1), ("_id", 1)])
+    # Held invites aren't queued yet, so they're left out of this one.
+    db.invites.create_index("queued", sparse=True)
+    db.invites.create_index([("group_id", 1), ("username", 1)], unique=True)
+    db.invites.create_index("username")
+    db.invites.create_index("claim", sparse=True)
+    db.invites.create_index("x", expireAfterSeconds=0)
+    # Invites queued before we had leases.
+    db.invites.update({"lease": {"$exists": False}}, {"$set": {"lease": 0}},
+                      multi=True)
+    # Invites held before they expired, or were left out of the queue.
+    expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=HELD_TTL)
+    db.invites.update({"held": True, "x": {"$exists": False}},
+                      {"$set": {"x": expires}}, multi=True)
+    db.invites.update({"held": True, "queued": {"$exists": True}},
+                      {"$unset": {"queued": 1}}, multi=True)
 
 
 # Caching arbitrary URIs
+@instrumented
 def memoized(uri):
-    doc = db.memo.find_one({"u": uri})
+    """Return the memo doc for `uri`.
+
+    That's {"d": data, "h": headers, "t": when we last knew it was fresh}.
+    """
+    doc = memo_cache.get(uri)
     if doc:
-        return doc["d"]
+        metrics.inc("memo_lookups", tier="process", result="hit")
+        return doc
+    metrics.inc("memo_lookups", tier="process", result="miss")
+    doc = db.memo.find_one({"u": uri})
+    if not doc:
+        memo_stats["misses"] += 1
+        metrics.inc("memo_lookups", tier="db", result="miss")
+        return None
+    memo_stats["hits"] += 1
+    metrics.inc("memo_lookups", tier="db", result="hit")
+    doc.setdefault("h", {})
+    ttl = doc.get("x") and seconds_until(doc["x"])
+    memo_cache.put(uri, doc, len(doc["d"]), ttl)
     return doc
 
 
-def memoize(uri, data):
-    db.memo.save({"u": uri, "d": data})
+@instrumented
+def memoize(uri, data, headers=None, ttl=None):
+    """Memo-ize `data` for `uri`, expiring it after `ttl` seconds.
+    """
+    doc = {"u": uri, "d": data, "h": headers or {}, "t": time.time()}
+    if ttl:
+        doc["x"] = datetime.datetime.utcnow() + datetime.timedelta(seconds=ttl)
+    db.memo.update({"u": uri}, doc, upsert=True)
+    memo_cache.put(uri, doc, len(data), ttl)
+
+
+@instrumented
+def refresh(doc):
+    """Mark memo `doc` as fresh (GH says it hasn't changed).
+    """
+    doc["t"] = time.time()
+    db.memo.update({"u": doc["u"]}, {"$set": {"t": doc["t"]}})
+
+
+def seconds_until(when):
+    now = datetime.datetime.utcnow()
+    if when.tzinfo:
+        when = when.replace(tzinfo=None) - when.utcoffset()
+    return max(0, (when - now).total_seconds())
+
+
+# Background jobs (for creating lists)
+@instrumented
+def new_job(owner, **fields):
+    """Create a queued job for `owner`, returning its id.
+    """
+    job_id = coding.b32enc(os.urandom(10))
+    fields.update({"_id": job_id,
+                   "owner": owner,
+                   "status": "queued",
+                   "created": time.time()})
+    db.jobs.insert(fields, safe=True)
+    return job_id
+
+
+@instrumented
+def claim_job(job_id, lease):
+    """Claim job `job_id` for `lease` seconds, and return it.
+
+    Queued and failed jobs can be claimed, as can running jobs whose
+    lease is up (their process died). Returns None for anything else.
+
+    Each claim gets its own token, so whoever claimed a job before can
+    tell they've lost it (see `renew_job`).
+    """
+    now = time.time()
+    return db.jobs.find_and_modify({"_id": job_id,
+                                    "$or": [{"status": {"$in": ["queued",
+                                                                "failed"]}},
+                                            {"status": "running",
+                                             "lease": {"$lt": now}},
+                                            {"status": "running",
+                                             "lease": {"$exists": False}}]},
+                                   {"$set": {"status": "running",
+                                             "lease": now + lease,
+                                             "claim": bson.ObjectId()},
+                                    "$unset": {"error": 1}},
+                                   new=True)
+
+
+@instrumented
+def retry_job(job_id):
+    """Put job `job_id` back on the queue, if it failed.
+    """
+    db.jobs.update({"_id": job_id, "status": "failed"},
+                   {"$set": {"status": "queued"}, "$unset": {"error": 1}})
+
+
+@instrumented
+def renew_job(job, lease, **fields):
+    """Renew our lease on `job` for another `lease` seconds, and set
+    `fields` (like {"cursors.watchers": 3}) on it.
+
+    Raises JobLost if somebody else has claimed `job` since we did.
+    """
+    fields["lease"] = time.time() + lease
+    result = db.jobs.update({"_id": job["_id"], "claim": job["claim"]},
+                            {"$set": fields}, safe=True)
+    if not result["n"]:
+        raise errors.JobLost("Job %s was claimed by somebody else" %
+                             job["_id"])
+
+
+@instrumented
+def unfinished_job(owner, repo, org=None):
+    """`owner`'s latest job for `repo` that hasn't finished, if any.
+    """
+    cursor = db.jobs.find({"owner": owner, "repo": repo, "org": org,
+                           "status": {"$ne": "done"}})
+    for doc in watch(cursor.sort("created", -1).limit(1)):
+        return doc
+    return None
+
+
+@instrumented
+def job(job_id):
+    return db.jobs.find_one({"_id": job_id})
+
+
+# GH rate limit budgets, shared by all of our processes
+@instrumented
+def take_call(bucket, limit, window):
+    """Take a call from `bucket`'s budget.
+
+    Returns 0 if we can go ahead, otherwise the number of seconds until
+    the budget is reset. If `bucket`'s window is over we start a new one
+    with `limit` calls for the next `window` seconds.
+    """
+    now = time.time()
+    while True:
+        if db.ratelimit.find_and_modify({"_id": bucket,
+                                         "remaining": {"$gt": 0},
+                                         "reset": {"$gt": now}},
+                                        {"$inc": {"remaining": -1}}):
+            return 0
+        try:
+            db.ratelimit.find_and_modify({"_id": bucket,
+                                          "reset": {"$lte": now}},
+                                         {"$set": {"remaining": limit - 1,
+                                                   "reset": now + window}},
+                                         upsert=True)
+            return 0
+        except pymongo.errors.DuplicateKeyError:
+            # The current window isn't over - is it used up, or did
+            # somebody else just start it?
+            doc = db.ratelimit.find_one({"_id": bucket})
+            if doc and doc["remaining"] <= 0:
+                return max(doc["reset"] - now, 0.01)
+
+
+@instrumented
+def give_call(bucket):
+    """Give back a call we took but GH didn't count.
+    """
+    db.ratelimit.update({"_id": bucket}, {"$inc": {"remaining": 1}})
+
+
+@instrumented
+def sync_rate_limit(bucket, remaining, reset):
+    """Set `bucket`'s budget to what GH says it is.
+    """
+    db.ratelimit.update({"_id": bucket},
+                        {"$set": {"remaining": remaining, "reset": reset}},
+                        upsert=True)
 
 
 # Created lists
+@instrumented
 def new_list(name, username, group_id):
-    db.lists.save({"name": name,
-                   "group_id": group_id,
-                   "username": username}, safe=True)
+    db.lists.update({"group_id": group_id},
+                    {"name": name,
+                     "group_id": group_id,
+                     "username": username}, upsert=True, safe=True)
 
 
+@instrumented
 def existing_own(name, username):
-    return db.lists.find({"name": name, "username": username})
+    return list(watch(db.lists.find({"name": name, "username": username})))
 
 
+@instrumented
 def existing_not_own(name, username):
-    return db.lists.find({"name": name, "username": {"$ne": username}})
+    # There are only ever a few lists with the same name, and "$ne"
+    # can't use our index - so we filter out `username`'s lists here.
+    return [l for l in watch(db.lists.find({"name": name}))
+            if l["username"] != username]
 
 
 # Memoizing github user data
+@instrumented
 def save_user(username, email_address, display_name):
     db.users.save({"_id": username,
                    "email": email_address,
                    "name": display_name}, safe=True)
 
 
+@instrumented
+def save_users(users):
+    """Save a batch of user docs from `lookup_user`, all at once.
+    """
+    if not users:
+        return
+    try:
+        db.users.insert([{"_id": username,
+                          "email": data.get("email", None),
+                          "name": data.get("name", None)}
+                         for (username, data) in users.items()],
+                        continue_on_error=True, safe=True)
+    except pymongo.errors.DuplicateKeyError:
+        # Somebody else saved some of them first, that's fine.
+        pass
+
+
+@instrumented
 def user(username):
     return db.users.find_one({"_id": username})
 
 
+@instrumented
+def users(usernames):
+    """Return a dict of the saved users for `usernames`, by username.
+    """
+    cursor = db.users.find({"_id": {"$in": list(usernames)}})
+    return dict((doc["_id"], doc) for doc in watch(cursor))
+
+
 # Invite queue
-def pending_invite(repo_name, github_url, inviter, username, group_id):
-    db.invites.save({"repo_name": repo_name,
-                     "github_url": github_url,
-                     "inviter": inviter,
-                     "username": username,
-                     "group_id": group_id}, safe=True)
+INVITE_CHUNK = 1000
+MAX_INVITE_TRIES = 5
+# The lease of held invites, which can't be claimed until they're released.
+# Held invites that are never released (their job failed, and nobody
+# retried it) expire after HELD_TTL seconds.
+HELD = float("inf")
+HELD_TTL = 7 * 24 * 60 * 60
+
+
+@instrumented
+def pending_invites(repo_name, github_url, inviter, usernames, group_id,
+                    delay=0, held=False):
+    """Queue invites for `usernames`, INVITE_CHUNK at a time.
+
+    The invites can't be claimed for `delay` seconds - or at all if
+    they're `held`, until `release_invites`. Anybody who's already got a
+    pending invite to `group_id` is skipped.
+    """
+    usernames = list(usernames)
+    lease = held and HELD or time.time() + delay
+    for i in range(0, len(usernames), INVITE_CHUNK):
+        invites = [{"repo_name": repo_name,
+                    "github_url": github_url,
+                    "inviter": inviter,
+                    "username": username,
+                    "group_id": group_id,
+                    "lease": lease}
+                   for username in usernames[i:i + INVITE_CHUNK]]
+        if held:
+            # They're queued when they're released.
+            expires = datetime.datetime.utcnow() + \
+                datetime.timedelta(seconds=HELD_TTL)
+            for invite in invites:
+                invite["held"] = True
+                invite["x"] = expires
+        else:
+            for invite in invites:
+                invite["queued"] = time.time()
+        try:
+            db.invites.insert(invites, continue_on_error=True, safe=True)
+        except pymongo.errors.DuplicateKeyError:
+            pass
+
+
+@instrumented
+def held_invites(group_id):
+    """How many invites to `group_id` are being held.
+    """
+    return db.invites.find({"group_id": group_id, "held": True}).count()
+
+
+@instrumented
+def drop_held_invites(held_as):
+    """Throw out the invites held as `held_as`.
+    """
+    db.invites.remove({"group_id": held_as, "held": True}, safe=True)
+
+
+@instrumented
+def release_invites(held_as, group_id, delay=0):
+    """Release the invites held as `held_as`, as invites to `group_id`.
+
+    They can be claimed in `delay` seconds.
+    """
+    now = time.time()
+    db.invites.update({"group_id": held_as, "held": True},
+                      {"$set": {"group_id": group_id,
+                                "queued": now,
+                                "lease": now + delay},
+                       "$unset": {"held": 1, "x": 1}},
+                      multi=True, safe=True)
+
+
+@instrumented
+def claim_invites(n, lease):
+    """Claim (up to) `n` claimable invites for `lease` seconds, taking
+    the ones that have been claimable longest first.
+
+    Along with those we claim every other unclaimed invite for the same
+    users, even ones that aren't claimable yet (but not held ones), so
+    each user's invites can be handled together.
+
+    Invites that aren't acked (see `ack_invite`) before their lease is up
+    can be claimed again. Invites that keep failing are dropped after
+    MAX_INVITE_TRIES.
+    """
+    while True:
+        now = time.time()
+        ids = [doc["_id"] for doc in
+               watch(db.invites.find({"lease": {"$lt": now}},
+                                     ["_id"]).sort([("lease", 1),
+                                                    ("_id", 1)]).limit(n))]
+        if not ids:
+            return []
+        claim = bson.ObjectId()
+        claimed = {"$set": {"lease": now + lease, "claim": claim},
+                   "$inc": {"tries": 1}}
+        db.invites.update({"_id": {"$in": ids}, "lease": {"$lt": now}},
+                          claimed, multi=True, safe=True)
+        cursor = db.invites.find({"claim": claim})
+        usernames = watch(cursor).distinct("username")
+        if usernames:
+            db.invites.update({"username": {"$in": usernames},
+                               "held": {"$exists": False},
+                               "$or": [{"claim": {"$exists": False}},
+                                       {"lease": {"$lt": now}}]},
+                              claimed, multi=True, safe=True)
+        invites = []
+        for invite in watch(db.invites.find({"claim": claim}).sort("_id", 1)):
+            if invite["tries"] > MAX_INVITE_TRIES:
+                logging.error("Giving up on invite %r" % invite)
+                ack_invite(invite)
+            else:
+                invites.append(invite)
+        # If somebody else beat us to all of those, try again.
+        if invites:
+            return invites
+
+
+@instrumented
+def next_claimable():
+    """When the next invite can be claimed, or None if the queue's empty.
+    """
+    cursor = db.invites.find({}, ["lease"]).sort("lease", 1).limit(1)
+    for doc in watch(cursor):
+        return doc["lease"]
+    return None
+
+
+@instrumented
+def invite_queue():
+    """How many invites are queued, how many of those can be claimed now,
+    and how long (in seconds) the oldest one has been waiting.
+
+    Held invites aren't waiting on us, so they don't count.
+    """
+    now = time.time()
+    oldest = None
+    cursor = db.invites.find({"queued": {"$gt": 0}}, ["queued"])
+    for doc in watch(cursor.sort("queued", 1).limit(1)):
+        oldest = now - doc["queued"]
+    return {"depth": db.invites.find({"lease": {"$lt": HELD}}).count(),
+            "ready": db.invites.find({"lease": {"$lt": now}}).count(),
+            "oldest": oldest}
+
+
+@instrumented
+def renew_invites(invites, lease):
+    """Extend our claim on `invites` to `lease` seconds from now.
+
+    Returns the ones we still hold - any whose lease was already up may
+    have been claimed by somebody else (or acked).
+    """
+    ids = [invite["_id"] for invite in invites]
+    spec = {"_id": {"$in": ids}, "claim": invites[0]["claim"]}
+    result = db.invites.update(spec, {"$set": {"lease": time.time() + lease}},
+                               multi=True, safe=True)
+    if result["n"] == len(ids):
+        return invites
+    held = set(doc["_id"] for doc in watch(db.invites.find(spec, ["_id"])))
+    return [invite for invite in invites if invite["_id"] in held]
+
+
+@instrumented
+def unclaim_invites(invites):
+    """Put `invites` (which we haven't tried to send) back on the queue.
+    """
+    if not invites:
+        return
+    db.invites.update({"_id": {"$in": [invite["_id"] for invite in invites]},
+                       "claim": invites[0]["claim"]},
+                      {"$set": {"lease": 0}, "$inc": {"tries": -1}},
+                      multi=True, safe=True)
+
+
+@instrumented
+def ack_invite(invite):
+    """We're done with `invite`, take it off of the queue for good.
+    """
+    db.invites.remove({"_id": invite["_id"], "claim": invite["claim"]})
+
+
+@instrumented
+def signal_invites():
+    """Let invite workers in every process know there are new invites.
+    """
+    db.signals.insert({"t": time.time()})
 
 
-def next_invite():
-    return db.invites.find_and_modify(remove=True, sort={'_id': 1})
+def tail_signals():
+    """Yield each new invite signal, as it's sent. Never returns.
+    """
+    last = None
+    for doc in db.signals.find().sort("$natural", -1).limit(1):
+        last = doc["_id"]
+    while True:
+        query = last and {"_id": {"$gt": last}} or {}
+        try:
+            cursor = db.signals.find(query, tailable=True, await_data=True)
+            while cursor.alive:
+                for doc in cursor:
+                    last = doc["_id"]
+                    yield doc
+        except pymongo.errors.OperationFailure:
+            # The collection was dropped, or isn't capped (yet).
+            pass
+        time.sleep(1)
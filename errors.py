@@ -13,6 +13,16 @@ class InvalidFormData(GitlistsError):
     """
 
 
+class JobFailed(GitlistsError):
+    """Raised when a background job can't be finished.
+    """
+
+
+class JobLost(GitlistsError):
+    """Raised when somebody else claims a background job we're running.
+    """
+
+
 class InternalError(GitlistsError):
     """Raised when we get in a weird state.
     """
@@ -1,4 +1,8 @@
 import json
+import logging
+import re
+import threading
+import time
 import urllib
 import urlparse
 
@@ -6,10 +10,83 @@ import decorator
 import flask
 
 import db
+import http_pool
+import jsonstream
+import metrics
+import pool
 import settings
+import sign
 
 
-urlopen = urllib.urlopen
+# GH calls go over keep-alive connections, pooled per host.
+http = http_pool.Client(getattr(settings, "github_connections",
+                                http_pool.MAX_PER_HOST),
+                        getattr(settings, "github_timeout", http_pool.TIMEOUT))
+
+
+def urlopen(url, params=None, headers=None):
+    return http.open(url, params, headers)
+
+
+# Pages of big lists are fetched concurrently, with at most this many
+# requests in flight at once.
+PAGE_WORKERS = 4
+page_pool = pool.Pool(PAGE_WORKERS)
+
+# Independent calls made while rendering a page run on this pool. Each
+# request gets its own lane of FANOUT_PER_REQUEST calls at once, and
+# there are enough threads for every request thread's lane (see
+# www.THREADS), so requests don't queue behind each other's calls. A
+# page gets CALL_TIMEOUT seconds for all of its calls.
+FANOUT_PER_REQUEST = 4
+FANOUT_WORKERS = FANOUT_PER_REQUEST * getattr(settings, "threads", 8)
+fanout_pool = pool.Pool(FANOUT_WORKERS)
+CALL_TIMEOUT = 10
+
+# Lets pooled calls act on behalf of the user (and request) that made them.
+_local = threading.local()
+
+# Response headers we care about (and keep alongside memo-ized data).
+KEEP_HEADERS = ("link", "etag", "last-modified")
+
+# How long (in seconds) memo-ized data is served without asking GH
+# whether it has changed. After that we revalidate with a conditional
+# request - a 304 costs us nothing against the rate limit.
+MEMO_FRESHNESS = 10 * 60
+
+# How long (in seconds) memo-ized data is kept at all, by endpoint.
+# The first pattern that matches wins.
+MEMO_TTLS = [(re.compile(r"^/orgs/[^/]+/repos"), 6 * 60 * 60),
+             (re.compile(r"^/orgs/"), 24 * 60 * 60),
+             (re.compile(r"^/repos/[^/]+/[^/]+/"), 24 * 60 * 60)]
+MEMO_TTL = 60 * 60
+
+# Endpoints whose data is the same whoever asks for it, so memo-ized
+# copies can be shared across users. Anything else (including org
+# members, which includes concealed members) is memo-ized per user -
+# unless the caller knows it's public, like a public repo's
+# contributors, watchers and forks (see `memo_key`).
+PUBLIC = [re.compile(r"^/users/[^/]+$")]
+
+# GH's rate limits as (calls, window in seconds), per token for the
+# authenticated API and per IP for the anonymous (v2) API. Every process
+# draws from the same budgets, which we resync from the X-RateLimit
+# headers GH sends back.
+RATE_LIMITS = {"user": (5000, 60 * 60),
+               "anonymous": (60, 60)}
+
+# The longest we'll sleep at once waiting for budget, in seconds.
+MAX_THROTTLE = 60
+
+# Names in paths, which we leave out of our metrics so there's just one
+# series per endpoint.
+ENDPOINTS = [(re.compile(r"^/repos/[^/]+/[^/]+"), "/repos/:owner/:repo"),
+             (re.compile(r"^/orgs/[^/]+"), "/orgs/:org"),
+             (re.compile(r"^/users/[^/]+"), "/users/:user"),
+             (re.compile(r"^/api/v2/json/user/show/[^/]+"),
+              "/api/v2/json/user/show/:user")]
+
+LAST_PAGE = re.compile(r'<[^>]*[?&]page=(\d+)[^>]*>;\s*rel="last"')
 
 
 class Error(Exception):
@@ -74,31 +151,370 @@ def finish_auth():
     return flask.redirect("/")
 
 
-def make_request(u, big=False, memoize=False):
-    # We try to memo-ize requests to keep from hammering GH's API.
-    u = "https://api.github.com%s?access_token=%s" % (u, flask.session["g"])
+def access_token():
+    return getattr(_local, "token", None) or flask.session["g"]
+
+
+def request_calls():
+    """Book-keeping for the GH calls made by the current request.
+
+    That's {"results": per_request results, "upstream": paths we
+    actually fetched, "deduped": calls answered from "results"}, or None
+    outside of a request.
+    """
+    calls = getattr(_local, "calls", None)
+    if calls is not None or not flask.has_request_context():
+        return calls
+    if not hasattr(flask.g, "github_calls"):
+        flask.g.github_calls = {"results": {}, "upstream": [], "deduped": []}
+    return flask.g.github_calls
+
+
+def bound(fn):
+    """Wrap `fn` to run on behalf of the current user and request.
+
+    For calling `fn` from another thread.
+    """
+    token = access_token()
+    calls = request_calls()
+
+    def call(*args):
+        _local.token = token
+        _local.calls = calls
+        try:
+            return fn(*args)
+        finally:
+            _local.token = None
+            _local.calls = None
+    return call
+
+
+def lane():
+    """The current request's lane on `fanout_pool` (or, outside of a
+    request, the whole pool).
+    """
+    if not flask.has_request_context():
+        return fanout_pool
+    if not hasattr(flask.g, "github_lane"):
+        flask.g.github_lane = pool.Lane(fanout_pool, FANOUT_PER_REQUEST)
+    return flask.g.github_lane
+
+
+def submit(fn, *args):
+    """Call `fn(*args)` on `fanout_pool`, on behalf of the current user.
+
+    Returns a `pool.Future`.
+    """
+    return lane().submit(bound(fn), *args)
+
+
+def call_deadline(timeout=None):
+    """When a page's pooled calls have to be done by: `timeout` (or
+    CALL_TIMEOUT) seconds from now.
+    """
+    return time.time() + (timeout or CALL_TIMEOUT)
+
+
+def result(future, deadline):
+    """Wait (until `deadline` at the latest) for `future`'s result.
+
+    Raises pool.Timeout if it isn't done by then.
+    """
+    return future.result(max(0, deadline - time.time()))
+
+
+@decorator.decorator
+def per_request(fn, *args, **kwargs):
+    """Only make any given call once per request.
+    """
+    calls = request_calls()
+    if calls is None:
+        return fn(*args, **kwargs)
+    key = (fn.__name__,) + args + tuple(sorted(kwargs.items()))
+    if key in calls["results"]:
+        calls["deduped"].append(key)
+    else:
+        calls["results"][key] = fn(*args, **kwargs)
+    return calls["results"][key]
+
+
+def call_summary():
+    """How many GH calls the current request made, for debugging.
+    """
+    calls = request_calls() or {"upstream": [], "deduped": []}
+    return {"upstream": len(calls["upstream"]),
+            "deduped": len(calls["deduped"])}
+
+
+def gather(futures, deadline=None):
+    """Wait for `futures` (until `deadline` at the latest), returning
+    None for any that failed or didn't finish in time.
+
+    Only errors that the view decorators handle are re-raised.
+    """
+    deadline = deadline or call_deadline()
+    results = []
+    for future in futures:
+        try:
+            results.append(result(future, deadline))
+        except (Reauthorize, RateLimited):
+            raise
+        except Exception:
+            logging.exception("Pooled GitHub call failed")
+            results.append(None)
+    return results
+
+
+def api_url(u, big=False):
+    url = "https://api.github.com%s?access_token=%s" % (u, access_token())
     if big:
-        u += "&per_page=100"
+        url += "&per_page=100"
+    return url
+
+
+def response_headers(response):
+    info = getattr(response, "info", None)
+    if not info:
+        return {}
+    info = info()
+    headers = {}
+    for name in KEEP_HEADERS + ("x-ratelimit-remaining", "x-ratelimit-reset"):
+        value = info.get(name)
+        if value is not None:
+            headers[name] = value
+    return headers
+
+
+def token_scope(token):
+    """An opaque name for `token`, safe to store."""
+    return sign.no_time_32(token)[:16]
+
+
+def memo_key(url, shared=False):
+    """The key we memo-ize `url` under.
+
+    That's the path and query without the access token, prefixed by
+    who can see it: "*" for public (or `shared`) data, or the token's
+    scope.
+    """
+    _, _, path, query, _ = urlparse.urlsplit(url)
+    params = dict(urlparse.parse_qsl(query))
+    token = params.pop("access_token", "")
+    key = path
+    if params:
+        key += "?" + urllib.urlencode(sorted(params.items()))
+    if shared or [p for p in PUBLIC if p.match(path)]:
+        return "*" + key
+    return token_scope(token) + key
+
+
+def endpoint(url):
+    """The endpoint `url` is a call to, for metrics.
+    """
+    path = urlparse.urlsplit(url).path
+    for pattern, name in ENDPOINTS:
+        path = pattern.sub(name, path, 1)
+    return path
+
+
+def call(url, headers=None):
+    """Open `url` and read the response, returning (response, data).
+
+    Every call we make to GH goes through here, so we can count them.
+    """
+    name = endpoint(url)
+    try:
+        with metrics.timed("github_seconds", endpoint=name):
+            response = urlopen(url, headers=headers)
+            data = response.read()
+    except IOError, e:
+        status = e.args[0] == "http error" and e.args[1] or "error"
+        metrics.inc("github_calls", endpoint=name, status=status)
+        raise
+    metrics.inc("github_calls", endpoint=name, status=response.getcode())
+    return response, data
+
+
+def rate_bucket(url):
+    token = urlparse.parse_qs(urlparse.urlsplit(url).query).get("access_token")
+    if token:
+        return "user/" + token_scope(token[0]), RATE_LIMITS["user"]
+    return "anonymous", RATE_LIMITS["anonymous"]
+
+
+def throttle(url, block=False):
+    """Take a call from the rate limit budget `url` is counted against.
+
+    If the budget's used up we either wait for it to reset (if `block`)
+    or raise RateLimited.
+    """
+    bucket, (limit, window) = rate_bucket(url)
+    while True:
+        wait = db.take_call(bucket, limit, window)
+        if not wait:
+            return bucket
+        if not block:
+            raise RateLimited()
+        time.sleep(min(wait, MAX_THROTTLE))
+
+
+def sync_rate_limit(bucket, headers):
+    try:
+        remaining = int(headers["x-ratelimit-remaining"])
+        reset = int(headers["x-ratelimit-reset"])
+    except (KeyError, ValueError):
+        return False
+    db.sync_rate_limit(bucket, remaining, reset)
+    return True
+
+
+def memo_ttl(url):
+    path = urlparse.urlsplit(url).path
+    for pattern, ttl in MEMO_TTLS:
+        if pattern.match(path):
+            return ttl
+    return MEMO_TTL
+
+
+def conditional_headers(doc):
+    headers = {}
+    if doc["h"].get("etag"):
+        headers["If-None-Match"] = doc["h"]["etag"]
+    if doc["h"].get("last-modified"):
+        headers["If-Modified-Since"] = doc["h"]["last-modified"]
+    return headers
+
+
+def projected(data, path):
+    """Just the values at `path` in each item of the JSON array `data`,
+    as a (much smaller) JSON array.
+
+    Anything other than an array (like an error) is left alone.
+    """
+    if not jsonstream.is_array(data):
+        return data
+    return json.dumps(list(jsonstream.project(data, path)))
+
+
+def fetch(url, memoize=False, project=None, shared=False):
+    """Fetch `url`, returning a (body, headers) tuple.
+
+    With `project` (a path like "owner.login") a list is cut down to
+    just those values before it's memo-ized and returned, see
+    `projected`. `shared` data is memo-ized for everybody, see
+    `memo_key`.
+
+    Doesn't touch the flask session, so it's safe to call from a pool.
+    """
+    # We try to memo-ize requests to keep from hammering GH's API.
+    key = memo_key(url, shared)
+    if project:
+        key += "#" + project
+    doc = None
     if memoize:
-        data = db.memoized(u)
-    if not memoize or not data:
-        try:
-            data = urlopen(u).read()
-            if memoize:
-                db.memoize(u, data)
-        except IOError, e:
-            if e.args[1] == 401:
-                raise Reauthorize("Got a 401...")
-            else:
-                raise
+        doc = db.memoized(key)
+        if doc and time.time() - doc.get("t", 0) < MEMO_FRESHNESS:
+            return doc["d"], doc["h"]
+    bucket = throttle(url)
+    calls = request_calls()
+    if calls is not None:
+        calls["upstream"].append(urlparse.urlsplit(url).path)
+    try:
+        response, data = call(url, doc and conditional_headers(doc))
+    except IOError, e:
+        if len(e.args) > 1 and e.args[1] == 401:
+            raise Reauthorize("Got a 401...")
+        else:
+            raise
+    headers = response_headers(response)
+    synced = sync_rate_limit(bucket, headers)
+    if doc and response.getcode() == 304:
+        # These don't count against the rate limit.
+        if not synced:
+            db.give_call(bucket)
+        db.refresh(doc)
+        headers.update(doc["h"])
+        return doc["d"], headers
+    if project:
+        data = projected(data, project)
+    if memoize:
+        keep = dict((k, v) for (k, v) in headers.items() if k in KEEP_HEADERS)
+        db.memoize(key, data, keep, memo_ttl(url))
+    return data, headers
+
+
+def decode(data):
     res = json.loads(data)
-    if "error" in res:
+    if isinstance(res, dict) and "error" in res:
         if "Rate Limit" in res["error"]:
             raise RateLimited()
         raise Error("GitHub error: " + repr(res["error"]))
     return res
 
 
+@per_request
+def make_request(u, big=False, memoize=False):
+    return versioned_request(u, big, memoize)[0]
+
+
+@per_request
+def versioned_request(u, big=False, memoize=False):
+    """Like `make_request`, but returns (data, version).
+
+    The version is GH's ETag for the data (or None if it didn't send
+    one), so it changes whenever the data does.
+    """
+    data, headers = fetch(api_url(u, big), memoize)
+    return decode(data), headers.get("etag")
+
+
+def last_page(headers):
+    match = LAST_PAGE.search(headers.get("link", ""))
+    if match:
+        return int(match.group(1))
+    return 1
+
+
+def pages(u, memoize=False, project=None, start=1, batch=None,
+          shared=False):
+    """Yield (page number, items) for each page of the list at `u`,
+    from page `start` on.
+
+    The Link header on the first page we fetch tells us how many pages
+    there are, the rest are fetched concurrently on `page_pool` - `batch`
+    pages at a time, or all at once. With `project` we only keep that
+    field of each item (see `fetch`, as for `shared`).
+    """
+    url = api_url(u, True)
+    first = start > 1 and url + "&page=%d" % start or url
+    data, headers = fetch(first, memoize, project, shared)
+    res = decode(data)
+    if not isinstance(res, list):
+        return
+    yield start, res
+
+    numbers = range(start + 1, last_page(headers) + 1)
+    if not numbers:
+        return
+
+    # Don't start on a list we don't have the budget to finish.
+    remaining = int(headers.get("x-ratelimit-remaining", len(numbers)))
+    if remaining < len(numbers):
+        raise RateLimited()
+
+    fetch_page = bound(lambda url: decode(fetch(url, memoize, project,
+                                                shared)[0]))
+    batch = batch or len(numbers)
+    for i in range(0, len(numbers), batch):
+        chunk = numbers[i:i + batch]
+        results = page_pool.map(fetch_page,
+                                [url + "&page=%d" % p for p in chunk],
+                                limit=remaining)
+        for (p, page) in zip(chunk, results):
+            yield p, isinstance(page, list) and page or []
+
+
+@per_request
 def current_user():
     data = make_request("/user")
     if data and data.get("email", None):
@@ -112,56 +528,76 @@ def current_user():
     return data
 
 
+def user_version():
+    """The version of `current_user`'s data (see `versioned_request`).
+    """
+    return versioned_request("/user")[1]
+
+
 def user_info(username):
     existing = db.user(username)
     if existing:
         return existing, True
 
-    u = "http://github.com/api/v2/json/user/show/" + username
-    data = json.load(urlopen(u))
-    if "error" in data:
-        raise Error("GitHub error: " + repr(data["error"]))
-    data = data["user"]
+    data = lookup_user(username)
     db.save_user(username, data.get("email", None), data.get("name", None))
     return data, False
 
 
-def repos(org=None):
-    if org:
-        return make_request("/orgs/%s/repos" % org, memoize=True)
-    return make_request("/user/repos")
-
-
-def user_list(url):
-    c = make_request(url, True, True)
-    if not c or isinstance(c, dict):
-        return []
-    return [x["login"] for x in c]
+def lookup_user(username):
+    """Look up `username` on GH (waiting for rate limit budget if need be).
 
+    Unlike `user_info` this doesn't check or save to our users collection.
+    """
+    u = "https://github.com/api/v2/json/user/show/" + username
+    bucket = throttle(u, block=True)
+    response, data = call(u)
+    sync_rate_limit(bucket, response_headers(response))
+    data = json.loads(data)
+    if "error" in data:
+        raise Error("GitHub error: " + repr(data["error"]))
+    return data["user"]
 
-def collaborators(user, name):
-    # TODO this call doesn't seem to be working for some reason...
-    return user_list("/repos/%s/%s/collaborators" % (user, name))
 
+def repos(org=None):
+    return versioned_repos(org)[0]
 
-def contributors(user, name):
-    return user_list("/repos/%s/%s/contributors" % (user, name))
 
+def versioned_repos(org=None):
+    """`repos`, as (repos, version) - see `versioned_request`.
+    """
+    if org:
+        return versioned_request("/orgs/%s/repos" % org, memoize=True)
+    return versioned_request("/user/repos")
 
-def forkers(user, name):
-    forks = make_request("/repos/%s/%s/forks" % (user, name), True)
-    if not forks or isinstance(forks, dict):
-        return []
-    return [f["owner"]["login"] for f in forks]
 
+def orgs():
+    return versioned_orgs()[0]
 
-def watchers(user, name):
-    return user_list("/repos/%s/%s/watchers" % (user, name))
 
+def versioned_orgs():
+    """`orgs`, as (orgs, version) - see `versioned_request`.
+    """
+    return versioned_request("/user/orgs")
 
-def orgs():
-    return make_request("/user/orgs")
 
+def audience_sources(user, name, org=None, private=True):
+    """The lists we find a list's audience in, paged through one by one.
 
-def members(org):
-    return user_list("/orgs/%s/members" % org)
+    That's (source, path, field, memo-ize?, shared?) for each, to pass
+    on to `pages`. A repo's contributors, forkers and watchers are the
+    same for anybody who can see it, so for public repos they're
+    memo-ized for everybody.
+    """
+    repo = "/repos/%s/%s" % (user, name)
+    public = not private
+    sources = [("collaborators", repo + "/collaborators", "login", True,
+                False),
+               ("contributors", repo + "/contributors", "login", True,
+                public)]
+    if org:
+        sources.append(("members", "/orgs/%s/members" % org, "login", True,
+                        False))
+    sources.append(("forkers", repo + "/forks", "owner.login", False, public))
+    sources.append(("watchers", repo + "/watchers", "login", True, public))
+    return sources
@@ -0,0 +1,159 @@
+"""An HTTP(S) client that keeps connections alive, pooled per host.
+
+Responses look like urllib's: they have `read`, `info` and `getcode`,
+and errors are raised the way urllib raises them.
+"""
+
+import httplib
+import os
+import socket
+import StringIO
+import sys
+import threading
+import urlparse
+import zlib
+
+
+# Connections we'll have open to any one host (and how long, in
+# seconds, we'll wait on them).
+MAX_PER_HOST = 8
+TIMEOUT = 10
+
+# Like urllib, we follow redirects for GETs - up to MAX_REDIRECTS of them.
+REDIRECTS = (301, 302, 303, 307)
+MAX_REDIRECTS = 10
+
+
+class Response(StringIO.StringIO):
+    """A response we've read all of (so its connection can be reused).
+    """
+
+    def __init__(self, url, status, reason, headers, body):
+        StringIO.StringIO.__init__(self, body)
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+
+class Host(object):
+    """Idle connections to a host, and how many more we're allowed.
+    """
+
+    def __init__(self, max_connections):
+        self.slots = threading.Semaphore(max_connections)
+        self.idle = []
+        self.lock = threading.Lock()
+
+
+class Client(object):
+
+    def __init__(self, max_per_host=MAX_PER_HOST, timeout=TIMEOUT):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.opened = 0
+        self._hosts = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _host(self, key):
+        with self._lock:
+            # Connections opened before a fork belong to our parent.
+            if self._pid != os.getpid():
+                self._hosts = {}
+                self._pid = os.getpid()
+            if key not in self._hosts:
+                self._hosts[key] = Host(self.max_per_host)
+            return self._hosts[key]
+
+    def _connect(self, scheme, netloc):
+        with self._lock:
+            self.opened += 1
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def close(self):
+        """Close all of our idle connections.
+        """
+        with self._lock:
+            hosts = self._hosts.values()
+        for host in hosts:
+            with host.lock:
+                idle, host.idle = host.idle, []
+            for connection in idle:
+                connection.close()
+
+    def open(self, url, params=None, headers=None):
+        """GET `url`, or POST `params` (urlencoded) to it.
+
+        Redirects are followed for GETs (to whatever host they point
+        at), and the response is the one from the end of the chain.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._request(url, params, headers)
+            location = response.headers.get("location")
+            if params is not None or location is None or \
+                    response.status not in REDIRECTS:
+                return response
+            url = urlparse.urljoin(url, location)
+        raise IOError("http error", response.status,
+                      "Too many redirects", response.headers)
+
+    def _request(self, url, params, headers):
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += "?" + query
+        method = params is None and "GET" or "POST"
+        request_headers = {"Accept-Encoding": "gzip"}
+        if params is not None:
+            request_headers["Content-Type"] = \
+                "application/x-www-form-urlencoded"
+        request_headers.update(headers or {})
+
+        host = self._host((scheme, netloc))
+        host.slots.acquire()
+        try:
+            with host.lock:
+                connection = host.idle and host.idle.pop() or None
+            # A kept-alive connection might have been closed on the other
+            # end, in which case we try a GET again on a new one.
+            for reused in [connection is not None, False]:
+                if not reused:
+                    connection = self._connect(scheme, netloc)
+                try:
+                    connection.request(method, path or "/", params,
+                                       request_headers)
+                    response = connection.getresponse()
+                    body = response.read()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    connection.close()
+                    if not reused or method != "GET":
+                        raise IOError, ("socket error", e), sys.exc_info()[2]
+            if response.will_close:
+                connection.close()
+            else:
+                with host.lock:
+                    host.idle.append(connection)
+        finally:
+            host.slots.release()
+
+        if response.getheader("content-encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if response.status in (401, 407):
+            # These are the errors urllib raises for, rather than
+            # returning the response.
+            raise IOError("http error", response.status, response.reason,
+                          response.msg)
+        return Response(url, response.status, response.reason,
+                        response.msg, body)
@@ -0,0 +1,58 @@
+"""Pulling a few fields out of big JSON arrays.
+
+Rather than decoding a whole array (and every object in it) at once, we
+decode one item at a time and keep just the fields we want.
+"""
+
+import json
+import re
+
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+def is_array(data):
+    return data[WHITESPACE.match(data).end():][:1] == "["
+
+
+def items(data):
+    """Yield each item of the JSON array `data`, in turn.
+    """
+    end = WHITESPACE.match(data).end()
+    if data[end:end + 1] != "[":
+        raise ValueError("Not a JSON array")
+    end = WHITESPACE.match(data, end + 1).end()
+    if data[end:end + 1] == "]":
+        return
+    while True:
+        item, end = _decoder.raw_decode(data, end)
+        yield item
+        end = WHITESPACE.match(data, end).end()
+        next = data[end:end + 1]
+        if next == "]":
+            return
+        if next != ",":
+            raise ValueError("Expecting , or ] at %d" % end)
+        end = WHITESPACE.match(data, end + 1).end()
+
+
+def get(item, path):
+    """`item`'s value at `path` (like "owner.login"), or None.
+    """
+    for key in path.split("."):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key)
+    return item
+
+
+def project(data, path):
+    """Yield the value at `path` in each item of the JSON array `data`.
+
+    Items without one are skipped.
+    """
+    for item in items(data):
+        value = get(item, path)
+        if value is not None:
+            yield value
@@ -0,0 +1,261 @@
+"""Process-wide counters, gauges and latency histograms."""
+
+import BaseHTTPServer
+import bisect
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+
+# Upper bounds (in seconds) of our latency buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    """Counts of observed values, by bucket (plus their sum).
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # The last count is for values over the biggest bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+_lock = threading.Lock()
+counters = {}
+histograms = {}
+# Values we only work out when asked, as {key: function}.
+gauges = {}
+# Functions that work out several gauges at once, as {name: value}.
+collectors = []
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, n=1, **labels):
+    """Add `n` to the counter `name` (with `labels`).
+    """
+    key = _key(name, labels)
+    with _lock:
+        counters[key] = counters.get(key, 0) + n
+
+
+def observe(name, value, **labels):
+    """Add `value` to the histogram `name` (with `labels`).
+    """
+    key = _key(name, labels)
+    with _lock:
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """Observe how long the `with` block takes in the histogram `name`.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def gauge(name, fn, **labels):
+    """Report whatever `fn()` returns as the gauge `name` (with `labels`).
+    """
+    with _lock:
+        gauges[_key(name, labels)] = fn
+
+
+def collect(fn):
+    """Report each {name: value} that `fn()` returns as a gauge.
+
+    For gauges that are cheaper to work out together than one by one.
+    """
+    with _lock:
+        collectors.append(fn)
+
+
+def counter(name, **labels):
+    with _lock:
+        return counters.get(_key(name, labels), 0)
+
+
+def histogram(name, **labels):
+    with _lock:
+        return histograms.get(_key(name, labels))
+
+
+def reset():
+    """Forget all counters and histograms (but not gauges).
+    """
+    with _lock:
+        counters.clear()
+        histograms.clear()
+
+
+def _value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _escape(value):
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return value.replace("\n", "\\n")
+
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for (k, v) in labels)
+
+
+def _gauge_values(asked, collecting):
+    values = []
+    for ((name, labels), fn) in asked:
+        try:
+            values.append(((name, labels), fn()))
+        except Exception:
+            logging.exception("Couldn't get gauge %s" % name)
+    for fn in collecting:
+        try:
+            values.extend(((name, ()), value)
+                          for (name, value) in fn().items())
+        except Exception:
+            logging.exception("Couldn't collect gauges from %r" % fn)
+    return sorted(values)
+
+
+def render(prefix="gitlists_", **labels):
+    """Everything, in Prometheus' text exposition format.
+
+    `labels` are added to every metric (to tell processes apart, say).
+    """
+    with _lock:
+        counted = sorted(counters.items())
+        observed = [(key, (h.buckets, list(h.counts), h.count, h.sum))
+                    for (key, h) in sorted(histograms.items())]
+        asked = sorted(gauges.items())
+        collecting = list(collectors)
+    constant = sorted(labels.items())
+
+    lines = []
+    typed = set()
+
+    def type_line(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append("# TYPE %s %s" % (name, kind))
+
+    for ((name, labels), value) in counted:
+        type_line(prefix + name, "counter")
+        lines.append("%s%s %s" % (prefix + name, _labels(labels, constant),
+                                  _value(value)))
+    for ((name, labels), (buckets, counts, count, total)) in observed:
+        name = prefix + name
+        labels = list(labels) + constant
+        type_line(name, "histogram")
+        cumulative = 0
+        for (le, n) in zip(buckets + (float("inf"),), counts):
+            cumulative += n
+            lines.append("%s_bucket%s %d" %
+                         (name, _labels(labels, [("le", _value(le))]),
+                          cumulative))
+        lines.append("%s_sum%s %s" % (name, _labels(labels), _value(total)))
+        lines.append("%s_count%s %d" % (name, _labels(labels), count))
+    for ((name, labels), value) in _gauge_values(asked, collecting):
+        if value is None:
+            continue
+        type_line(prefix + name, "gauge")
+        lines.append("%s%s %s" % (prefix + name, _labels(labels, constant),
+                                  _value(value)))
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render(**self.server.labels)
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Listener(threading.Thread):
+    '''
+    Serves `render(**labels)` over HTTP on `port`, for processes that
+    don't serve anything else (see `serve`).
+
+    If `port` is taken - say by the process we're replacing, which is
+    still draining - we keep trying every RETRY_INTERVAL seconds until
+    it's free.
+    '''
+
+    RETRY_INTERVAL = 1
+
+    def __init__(self, port, host="", **labels):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = (host, port)
+        self.labels = labels
+        self.stopped = threading.Event()
+        self.bound = threading.Event()
+
+    def run(self):
+        while not self.stopped.isSet():
+            try:
+                server = BaseHTTPServer.HTTPServer(self.address, _Handler)
+                break
+            except socket.error:
+                self.stopped.wait(self.RETRY_INTERVAL)
+        else:
+            return
+        server.labels = self.labels
+        # So we notice when we're stopped.
+        server.timeout = self.RETRY_INTERVAL
+        self.port = server.server_address[1]
+        self.bound.set()
+        try:
+            while not self.stopped.isSet():
+                server.handle_request()
+        finally:
+            server.server_close()
+
+    def stop(self, timeout=None):
+        """Stop serving, waiting (up to `timeout` seconds) for the port to
+        be free.
+        """
+        self.stopped.set()
+        self.join(timeout)
+
+
+def serve(port, host="", **labels):
+    """Serve our metrics (with `labels`) on `port`, from a daemon thread.
+
+    Returns the `Listener`.
+    """
+    listener = Listener(port, host, **labels)
+    listener.start()
+    return listener
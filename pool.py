@@ -0,0 +1,163 @@
+"""A small, fixed-size thread pool.
+
+Threads are started lazily (and restarted after a fork), so it's safe to
+create pools at import time.
+"""
+
+import collections
+import os
+import Queue
+import sys
+import threading
+import time
+
+import errors
+
+
+class Timeout(errors.GitlistsError):
+    """Raised when a pooled call doesn't finish in time.
+    """
+
+
+class Future(object):
+    """The eventual result of a call submitted to a `Pool`.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.isSet()
+
+    def result(self, timeout=None):
+        """Wait for the call and return its result (or re-raise its error).
+
+        timeout is in seconds.
+        """
+        self._done.wait(timeout)
+        if not self.done():
+            raise Timeout("Call didn't finish in %r seconds" % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class Pool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._unfinished = 0
+        self._changed = threading.Condition()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # Calls our parent was making aren't ours to wait for.
+            self._unfinished = 0
+            for _ in range(self.size):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        while True:
+            future, fn, args, kwargs = self._queue.get()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except:
+                future.set_exc_info(sys.exc_info())
+            with self._changed:
+                self._unfinished -= 1
+                self._changed.notifyAll()
+
+    def submit(self, fn, *args, **kwargs):
+        self._ensure_started()
+        with self._changed:
+            self._unfinished += 1
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def map(self, fn, items, limit=None, timeout=None):
+        """Call `fn` on each of `items`, returning the results in order.
+
+        At most `limit` calls are in flight at once. The first error
+        raised by a call is re-raised here.
+        """
+        limit = max(1, min(limit or self.size, self.size))
+        items = list(items)
+        futures = [self.submit(fn, x) for x in items[:limit]]
+        results = []
+        for i in range(len(items)):
+            results.append(futures[i].result(timeout))
+            if i + limit < len(items):
+                futures.append(self.submit(fn, items[i + limit]))
+        return results
+
+    def join(self, timeout):
+        """Wait (up to `timeout` seconds) for every call we've been given.
+
+        Returns whether they all finished.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            while self._unfinished and time.time() < deadline:
+                self._changed.wait(deadline - time.time())
+            return not self._unfinished
+
+
+class Lane(object):
+    """A share of a `Pool`: calls submitted here run on `pool`, at most
+    `width` of them at once. The rest wait their turn here.
+
+    Give everybody using a pool their own lane (and the pool `width`
+    threads per lane) and nobody's calls wait behind anybody else's.
+    """
+
+    def __init__(self, pool, width):
+        self.pool = pool
+        self.width = width
+        self._waiting = collections.deque()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        with self._lock:
+            start = self._running < self.width
+            if start:
+                self._running += 1
+            else:
+                self._waiting.append((future, fn, args, kwargs))
+        if start:
+            self.pool.submit(self._run, future, fn, args, kwargs)
+        return future
+
+    def _run(self, future, fn, args, kwargs):
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except:
+            future.set_exc_info(sys.exc_info())
+        with self._lock:
+            if not self._waiting:
+                self._running -= 1
+                return
+            next = self._waiting.popleft()
+        self.pool.submit(self._run, *next)
@@ -13,19 +13,44 @@ TIMEOUT = 1
 BAD = 2
 
 
+# HMAC state that's already been keyed, by key. Keying it means hashing
+# the key twice over, so we only do it once and copy the result.
+_keyed = {}
+
+
+def digest(message):
+    """The HMAC-SHA1 of `message`, keyed with settings.message_key.
+    """
+    key = settings.message_key
+    keyed = _keyed.get(key)
+    if keyed is None:
+        keyed = _keyed[key] = hmac.new(key, digestmod=hashlib.sha1)
+    sig = keyed.copy()
+    sig.update(message)
+    return sig.digest()
+
+
+def _compare_digest(a, b):
+    result = len(a) ^ len(b)
+    for (x, y) in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+# Compares signatures in time that doesn't depend on where they differ.
+compare_digest = getattr(hmac, "compare_digest", _compare_digest)
+
+
 def no_time_32(message):
-    sig = hmac.new(settings.message_key, message, hashlib.sha1)
-    return coding.b32enc(sig.digest())
+    return coding.b32enc(digest(message))
 
 
 def no_time(message):
-    sig = hmac.new(settings.message_key, message, hashlib.sha1)
-    return coding.b64enc(sig.digest())
+    return coding.b64enc(digest(message))
 
 
 def dns_safe(message):
-    sig = hmac.new(settings.message_key, message, hashlib.sha1)
-    return base64.b32encode(sig.digest()).lower()
+    return base64.b32encode(digest(message)).lower()
 
 
 def sign(message):
@@ -34,12 +59,24 @@ def sign(message):
     return created + "|" + sig
 
 
+def sign_many(messages):
+    """sign() each of `messages`, with the same timestamp.
+    """
+    created = coding.urlenc_int(int(time.time()))
+    return [created + "|" + no_time(message + created)
+            for message in messages]
+
+
 def check_sig(message, sig, timeout=False):
     """timeout is in seconds."""
     if not sig or "|" not in sig:
         return BAD
-    created, sig = sig.split("|", 1)
-    if not sig == no_time(message + created):
+    try:
+        # Form values are unicode, but signatures are always ASCII.
+        created, sig = str(sig).split("|", 1)
+    except UnicodeError:
+        return BAD
+    if not compare_digest(sig, no_time(message + created)):
         return BAD
     if timeout:
         now = time.time()
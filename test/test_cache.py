@@ -0,0 +1,41 @@
+import sys
+import time
+import unittest
+sys.path[0:0] = [""]
+
+import cache
+
+
+class TestLRU(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRU(2, 100)
+        lru.put("a", 1)
+        lru.put("b", 2)
+        self.assertEqual(1, lru.get("a"))
+        lru.put("c", 3)
+        self.assertEqual(None, lru.get("b"))
+        self.assertEqual(1, lru.get("a"))
+        self.assertEqual(3, lru.get("c"))
+        self.assertEqual({"hits": 3, "misses": 1, "evictions": 1}, lru.stats)
+
+    def test_byte_limit(self):
+        lru = cache.LRU(10, 10)
+        lru.put("a", "aaaaaa", 6)
+        lru.put("b", "bbbbbb", 6)
+        self.assertEqual(None, lru.get("a"))
+        self.assertEqual(6, lru.bytes)
+
+        lru.put("c", "c" * 11, 11)
+        self.assertEqual(None, lru.get("c"))
+        self.assertEqual(1, len(lru))
+
+    def test_ttl(self):
+        lru = cache.LRU(10, 10)
+        lru.put("a", 1, ttl=0.01)
+        lru.put("b", 2)
+        self.assertEqual(1, lru.get("a"))
+        time.sleep(0.02)
+        self.assertEqual(None, lru.get("a"))
+        self.assertEqual(2, lru.get("b"))
+        self.assertEqual(1, lru.bytes)
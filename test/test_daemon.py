@@ -0,0 +1,101 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import unittest
+import urllib2
+sys.path[0:0] = [""]
+
+import daemon
+
+
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+def app(environ, start_response):
+    if environ["PATH_INFO"] == "/slow":
+        time.sleep(0.5)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["%d %d" % (os.getpid(), environ["worker"])]
+
+
+class TestPrefork(unittest.TestCase):
+
+    def setUp(self):
+        self.numbers = {}
+
+        def serve(number):
+            self.server.app = lambda e, s: app(dict(e, worker=number), s)
+            self.server.serve_until_stopped()
+            if not self.server.drain(5):
+                os._exit(2)
+
+        self.server = daemon.PooledWSGIServer("127.0.0.1", 0, app, 2)
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        prefork = daemon.Prefork(2, serve)
+        prefork.RESPAWN_DELAY = 0
+        self.master = os.fork()
+        if not self.master:
+            try:
+                prefork.run()
+            except SystemExit, e:
+                os._exit(e.code or 0)
+            os._exit(1)
+        self.server.server_close()
+
+    def tearDown(self):
+        if self.master:
+            os.kill(self.master, signal.SIGTERM)
+            os.waitpid(self.master, 0)
+
+    def get(self, path=""):
+        response = urllib2.urlopen(self.url + path, timeout=5)
+        pid, number = response.read().split()
+        return int(pid), int(number)
+
+    def workers(self):
+        """Make requests until we've heard from both workers.
+        """
+        seen = {}
+        for _ in range(200):
+            pid, number = self.get()
+            seen[number] = pid
+            if len(seen) == 2:
+                return seen
+        self.fail("Only heard from %r" % seen)
+
+    def test_workers_share_socket(self):
+        seen = self.workers()
+        self.assertEqual([0, 1], sorted(seen))
+        self.assertNotEqual(seen[0], seen[1])
+        self.assert_(self.master not in seen.values())
+
+    def test_dead_workers_are_replaced(self):
+        seen = self.workers()
+        os.kill(seen[0], signal.SIGKILL)
+        time.sleep(1)
+        new = self.workers()
+        self.assertNotEqual(seen[0], new[0])
+        self.assertEqual(seen[1], new[1])
+
+    def test_stop(self):
+        seen = self.workers()
+        os.kill(self.master, signal.SIGTERM)
+        os.waitpid(self.master, 0)
+        self.master = None
+        for pid in seen.values():
+            self.assertRaises(OSError, os.kill, pid, 0)
+
+    def test_stop_drains_requests(self):
+        self.workers()
+        results = []
+        slow = threading.Thread(target=lambda: results.append(self.get("slow")))
+        slow.start()
+        time.sleep(0.2)
+        os.kill(self.master, signal.SIGTERM)
+        _, status = os.waitpid(self.master, 0)
+        self.master = None
+        slow.join()
+        self.assertEqual(1, len(results))
+        self.assertEqual(0, status)
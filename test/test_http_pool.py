@@ -0,0 +1,150 @@
+import BaseHTTPServer
+import gzip
+import SocketServer
+import StringIO
+import sys
+import threading
+import unittest
+sys.path[0:0] = [""]
+
+import http_pool
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/loop":
+            self.server.loops += 1
+            self.path = "/moved/302//loop"
+        if self.path.startswith("/moved/"):
+            # Moved to the rest of the path (on another host, maybe).
+            self.send_response(int(self.path.split("/")[2]))
+            self.send_header("Location", self.path.split("/", 3)[3])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = '{"path": "%s"}' % self.path
+        status = self.path == "/private" and 401 or 200
+        self.send_response(status)
+        if "gzip" in self.headers.get("Accept-Encoding", "") and \
+                self.path == "/gzipped":
+            buf = StringIO.StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb")
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        if self.path == "/close":
+            self.send_header("Connection", "close")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"abc"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = self.rfile.read(length)
+        self.send_response(self.path.startswith("/moved/") and 302 or 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    loops = 0
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self.client = http_pool.Client(2, 5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for path in ["/a", "/b?x=1", "/c"]:
+            response = self.client.open(self.url + path)
+            self.assertEqual(200, response.getcode())
+            self.assertEqual('{"path": "%s"}' % path, response.read())
+            self.assertEqual('"abc"', response.info().get("etag"))
+        self.assertEqual(1, self.client.opened)
+
+        self.client.open(self.url + "/close")
+        self.client.open(self.url + "/a")
+        self.assertEqual(2, self.client.opened)
+
+    def test_gzip(self):
+        response = self.client.open(self.url + "/gzipped")
+        self.assertEqual('{"path": "/gzipped"}', response.read())
+
+    def test_post(self):
+        response = self.client.open(self.url + "/token", "code=123")
+        self.assertEqual("code=123", response.read())
+
+    def test_redirects(self):
+        for status in [301, 302, 303, 307]:
+            response = self.client.open("%s/moved/%d//a" % (self.url, status))
+            self.assertEqual(200, response.getcode())
+            self.assertEqual('{"path": "/a"}', response.read())
+            self.assertEqual(self.url + "/a", response.geturl())
+
+        # To another host.
+        other = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=other.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = "http://127.0.0.1:%d/b" % other.server_port
+            response = self.client.open(self.url + "/moved/301/" + url)
+            self.assertEqual('{"path": "/b"}', response.read())
+            self.assertEqual(url, response.geturl())
+        finally:
+            other.shutdown()
+            other.server_close()
+
+        # POSTs aren't redirected.
+        response = self.client.open(self.url + "/moved/302//a", "code=123")
+        self.assertEqual(302, response.getcode())
+
+    def test_redirect_loop(self):
+        try:
+            self.client.open(self.url + "/loop")
+        except IOError, e:
+            self.assertEqual(("http error", 302), e.args[:2])
+        else:
+            self.fail("No IOError")
+        self.assertEqual(http_pool.MAX_REDIRECTS + 1, self.server.loops)
+
+    def test_401(self):
+        try:
+            self.client.open(self.url + "/private")
+        except IOError, e:
+            self.assertEqual(("http error", 401), e.args[:2])
+        else:
+            self.fail("No IOError")
+
+    def test_stale_connection(self):
+        self.client.open(self.url + "/a")
+        for connection in self.client._host(("http", self.url[7:])).idle:
+            connection.sock.close()
+        self.assertEqual('{"path": "/b"}',
+                         self.client.open(self.url + "/b").read())
+        self.assertEqual(2, self.client.opened)
+
+    def test_connection_refused(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.assertRaises(IOError, self.client.open, self.url + "/a")
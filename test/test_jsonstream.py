@@ -0,0 +1,38 @@
+import json
+import sys
+import unittest
+sys.path[0:0] = [""]
+
+import jsonstream
+
+
+class TestJSONStream(unittest.TestCase):
+
+    def test_items(self):
+        data = [{"login": "a"}, 1, "two", [3], None, {"x": {"y": "]"}}]
+        self.assertEqual(data, list(jsonstream.items(json.dumps(data))))
+        self.assertEqual(data, list(jsonstream.items(
+                    json.dumps(data, indent=2))))
+        self.assertEqual([], list(jsonstream.items(" [ ] ")))
+
+    def test_bad_json(self):
+        for data in ['{"login": "a"}', '[1 2]', '[1,', '[']:
+            self.assertRaises(ValueError, list, jsonstream.items(data))
+
+    def test_is_array(self):
+        self.assertTrue(jsonstream.is_array("\n [1]"))
+        self.assertFalse(jsonstream.is_array('{"error": "Not Found"}'))
+        self.assertFalse(jsonstream.is_array(""))
+
+    def test_project(self):
+        data = json.dumps([{"owner": {"login": "a", "id": 1}},
+                           {"owner": None},
+                           {"name": "no owner"},
+                           {"owner": {"login": "b"}}])
+        self.assertEqual(["a", "b"],
+                         list(jsonstream.project(data, "owner.login")))
+        self.assertEqual([], list(jsonstream.project(data, "login")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import sys
+import unittest
+import urllib2
+sys.path[0:0] = [""]
+
+import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.gauges = dict(metrics.gauges)
+        metrics.gauges.clear()
+        self.collectors = list(metrics.collectors)
+        del metrics.collectors[:]
+
+    def tearDown(self):
+        metrics.gauges.clear()
+        metrics.gauges.update(self.gauges)
+        metrics.collectors[:] = self.collectors
+
+    def test_counters(self):
+        metrics.inc("calls", fn="a")
+        metrics.inc("calls", 2, fn="a")
+        metrics.inc("calls", fn="b")
+        self.assertEqual(3, metrics.counter("calls", fn="a"))
+        self.assertEqual(1, metrics.counter("calls", fn="b"))
+        self.assertEqual(0, metrics.counter("calls", fn="c"))
+
+    def test_histograms(self):
+        metrics.observe("seconds", 0.001, fn="a")
+        metrics.observe("seconds", 0.3, fn="a")
+        metrics.observe("seconds", 60, fn="a")
+        histogram = metrics.histogram("seconds", fn="a")
+        self.assertEqual(3, histogram.count)
+        self.assertAlmostEqual(60.301, histogram.sum)
+        self.assertEqual(1, histogram.counts[0])
+        self.assertEqual(1, histogram.counts[metrics.BUCKETS.index(0.5)])
+        self.assertEqual(1, histogram.counts[-1])
+        self.assertEqual(None, metrics.histogram("seconds", fn="b"))
+
+    def test_render(self):
+        metrics.inc("calls", fn="a")
+        metrics.observe("seconds", 0.3, fn='say "hi"')
+        metrics.gauge("depth", lambda: 7)
+        metrics.gauge("broken", lambda: 1 / 0)
+        lines = metrics.render().splitlines()
+        self.assertEqual(["# TYPE gitlists_calls counter",
+                          'gitlists_calls{fn="a"} 1.0',
+                          "# TYPE gitlists_seconds histogram"], lines[:3])
+        self.assertIn('gitlists_seconds_bucket{fn="say \\"hi\\"",le="0.25"} 0',
+                      lines)
+        self.assertIn('gitlists_seconds_bucket{fn="say \\"hi\\"",le="0.5"} 1',
+                      lines)
+        self.assertIn('gitlists_seconds_bucket{fn="say \\"hi\\"",le="+Inf"} 1',
+                      lines)
+        self.assertIn('gitlists_seconds_count{fn="say \\"hi\\""} 1', lines)
+        self.assertEqual(["# TYPE gitlists_depth gauge",
+                          "gitlists_depth 7.0"], lines[-2:])
+
+    def test_collect(self):
+        calls = []
+        def queue():
+            calls.append(1)
+            return {"queue_depth": 3, "queue_oldest": None}
+        metrics.collect(queue)
+        metrics.collect(lambda: 1 / 0)
+        metrics.gauge("other", lambda: 1)
+        self.assertEqual(["# TYPE gitlists_other gauge",
+                          "gitlists_other 1.0",
+                          "# TYPE gitlists_queue_depth gauge",
+                          "gitlists_queue_depth 3.0"],
+                         metrics.render().splitlines())
+        self.assertEqual(1, len(calls))
+
+    def test_constant_labels(self):
+        metrics.inc("calls", fn="a")
+        metrics.observe("seconds", 0.3)
+        metrics.gauge("depth", lambda: 7)
+        lines = metrics.render(worker=2).splitlines()
+        self.assertIn('gitlists_calls{fn="a",worker="2"} 1.0', lines)
+        self.assertIn('gitlists_seconds_bucket{worker="2",le="0.5"} 1', lines)
+        self.assertIn('gitlists_seconds_count{worker="2"} 1', lines)
+        self.assertIn('gitlists_depth{worker="2"} 7.0', lines)
+
+    def test_serve(self):
+        metrics.inc("calls", fn="a")
+        listener = metrics.serve(0, "127.0.0.1", process="worker")
+        try:
+            self.assert_(listener.bound.wait(5))
+            response = urllib2.urlopen("http://127.0.0.1:%d/metrics" %
+                                       listener.port)
+            self.assertEqual(metrics.CONTENT_TYPE,
+                             response.info()["Content-Type"])
+            self.assertIn('gitlists_calls{fn="a",process="worker"} 1.0',
+                          response.read())
+        finally:
+            listener.stop(5)
+        self.assertFalse(listener.isAlive())
@@ -0,0 +1,51 @@
+import sys
+import threading
+import time
+import unittest
+sys.path[0:0] = [""]
+
+import pool
+
+
+class TestPool(unittest.TestCase):
+
+    def test_map(self):
+        p = pool.Pool(3)
+        self.assertEqual([1, 4, 9, 16], p.map(lambda x: x * x, [1, 2, 3, 4]))
+
+    def test_timeout(self):
+        p = pool.Pool(1)
+        future = p.submit(time.sleep, 0.2)
+        self.assertRaises(pool.Timeout, future.result, 0.01)
+        self.assertEqual(None, future.result(1))
+
+    def test_join(self):
+        p = pool.Pool(2)
+        self.assert_(p.join(0))
+        done = threading.Event()
+        for _ in range(3):
+            p.submit(done.wait)
+        self.failIf(p.join(0.05))
+        done.set()
+        self.assert_(p.join(1))
+
+    def test_lane(self):
+        p = pool.Pool(4)
+        lane = pool.Lane(p, 2)
+        done = threading.Event()
+        running = []
+
+        def call(x):
+            running.append(x)
+            done.wait()
+            return x
+        futures = [lane.submit(call, x) for x in range(5)]
+        time.sleep(0.05)
+        self.assertEqual([0, 1], sorted(running))
+
+        # Other lanes still have the rest of the pool.
+        other = pool.Lane(p, 2)
+        self.assertEqual(5, other.submit(lambda: 5).result(1))
+
+        done.set()
+        self.assertEqual(range(5), [f.result(1) for f in futures])
@@ -0,0 +1,50 @@
+import sys
+import time
+import unittest
+sys.path[0:0] = [""]
+
+import coding
+import sign
+
+
+class TestCoding(unittest.TestCase):
+
+    def test_urlenc_int(self):
+        for i in [0, 1, 63, 64, 12345, int(time.time()), 2 ** 70]:
+            self.assertEqual(i, coding.urldec_int(coding.urlenc_int(i)))
+        self.assertEqual("10", coding.urlenc_int(64))
+        self.assertEqual(0, coding.urldec_int(""))
+        self.assertRaises(ValueError, coding.urldec_int, "a|b")
+
+
+class TestSign(unittest.TestCase):
+
+    def test_check_sig(self):
+        sig = sign.sign("message")
+        self.assertEqual(sign.OKAY, sign.check_sig("message", sig, 60))
+        self.assertEqual(sign.OKAY, sign.check_sig("message", unicode(sig)))
+        self.assertEqual(sign.BAD, sign.check_sig("other", sig))
+        self.assertEqual(sign.BAD, sign.check_sig("message", sig[:-1]))
+        self.assertEqual(sign.BAD, sign.check_sig("message", None))
+        self.assertEqual(sign.BAD, sign.check_sig("message", u"\xe9|x"))
+
+        old = coding.urlenc_int(int(time.time()) - 120)
+        sig = old + "|" + sign.no_time("message" + old)
+        self.assertEqual(sign.TIMEOUT, sign.check_sig("message", sig, 60))
+
+    def test_sign_many(self):
+        sigs = sign.sign_many(["a", "b"])
+        self.assertEqual(2, len(sigs))
+        self.assertEqual(sign.OKAY, sign.check_sig("a", sigs[0], 60))
+        self.assertEqual(sign.OKAY, sign.check_sig("b", sigs[1], 60))
+
+    def test_compare_digest(self):
+        for compare in [sign.compare_digest, sign._compare_digest]:
+            self.assertTrue(compare("abc", "abc"))
+            self.assertFalse(compare("abc", "abd"))
+            self.assertFalse(compare("abc", "ab"))
+            self.assertTrue(compare("", ""))
+
+
+if __name__ == '__main__':
+    unittest.main()
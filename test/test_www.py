@@ -1,19 +1,27 @@
+import hashlib
 import json
 import re
 import StringIO
 import sys
+import threading
 import time
 import unittest
 import urllib
+import urlparse
 sys.path[0:0] = [""]
 
 import fiesta
+import flask
 import webtest
 
+import coding
 import db
 import errors
 import github
+import metrics
 import settings
+import sign
+import worker
 import www
 
 
@@ -21,28 +29,81 @@ GITHUB = {}
 
 RATE_LIMITED = False
 
+NOT_MODIFIED = []
 
-www.SLEEP_INTERVAL = 0.01
+USER_LOOKUPS = []
+
+ACCESS_TOKEN = "dummy"
+
+
+class Response(StringIO.StringIO):
+
+    def __init__(self, body, headers=None, code=200):
+        StringIO.StringIO.__init__(self, body)
+        self.headers = headers or {}
+        self.code = code
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+
+def paged(url, data):
+    """Slice `data` the way GH would for a paginated request to `url`.
+    """
+    query = urlparse.parse_qs(urlparse.urlsplit(url).query)
+    if "per_page" not in query or not isinstance(data, list):
+        return data, {}
+    per_page = int(query["per_page"][0])
+    page = int(query.get("page", ["1"])[0])
+    headers = {}
+    last = (len(data) + per_page - 1) // per_page
+    if last > 1:
+        headers["link"] = '<%s&page=%d>; rel="last"' % (url, last)
+    return data[(page - 1) * per_page:page * per_page], headers
+
+
+def audience(source, user, name, org=None, private=True):
+    """Every page of `source` from `github.audience_sources`.
+    """
+    for (s, path, field, memoize, shared) in github.audience_sources(
+            user, name, org, private):
+        if s == source:
+            res = []
+            for _, page in github.pages(path, memoize, field, shared=shared):
+                res.extend(page)
+            return res
 
 
 # A little monkey-patching
-def our_urlopen(url, params=None):
+def our_urlopen(url, params=None, headers=None):
     global GITHUB
     global RATE_LIMITED
     response = ""
+    response_headers = {}
     gh_match = re.match(r"^https://api\.github\.com(/.*)\?.+$", url)
     if url.startswith("https://github.com/login/oauth/access_token"):
-        response = 'access_token=dummy'
+        response = 'access_token=' + ACCESS_TOKEN
     elif gh_match and RATE_LIMITED:
         response = json.dumps({'error': 'Rate Limit Exceeded'})
-    elif url.startswith("http://github.com/api/v2/json/user/show/"):
+    elif url.startswith("https://github.com/api/v2/json/user/show/"):
         _, _, handle = url.rpartition("/")
+        USER_LOOKUPS.append(handle)
         response = json.dumps(GITHUB.get("_user/" + handle))
+    elif gh_match and isinstance(GITHUB.get(gh_match.group(1)), Exception):
+        raise GITHUB[gh_match.group(1)]
     elif gh_match:
-        response = json.dumps(GITHUB.get(gh_match.group(1)))
+        data, response_headers = paged(url, GITHUB.get(gh_match.group(1)))
+        response = json.dumps(data)
+        response_headers["etag"] = '"%s"' % hashlib.md5(response).hexdigest()
+        if (headers or {}).get("If-None-Match") == response_headers["etag"]:
+            NOT_MODIFIED.append(gh_match.group(1))
+            return Response("", response_headers, 304)
     if not response:
         raise Exception("No reponse %r" % url)
-    return StringIO.StringIO(response)
+    return Response(response, response_headers)
 github.urlopen = our_urlopen
 
 
@@ -50,6 +111,9 @@ sandbox = fiesta.FiestaAPISandbox(settings.fiesta_id,
                                   settings.fiesta_secret,
                                   "gitlists.com")
 www.fiesta_api = sandbox
+worker.fiesta_api = sandbox
+worker.COALESCE_WINDOW = 0
+worker.start()
 
 
 class BaseTest(unittest.TestCase):
@@ -85,6 +149,16 @@ class BaseTest(unittest.TestCase):
         headers={"REFERER": form.response.request.url}
         return self.follow(form.submit(headers=headers))
 
+    def finish_job(self, response):
+        """Wait for the job whose status page is `response` to finish.
+        """
+        for _ in range(50):
+            if "Hang on" not in response:
+                return response
+            time.sleep(0.02)
+            response = self.get(response.request.url, response)
+        self.fail("Job didn't finish: %r" % response)
+
 
 class TestWWW(BaseTest):
 
@@ -95,6 +169,13 @@ class TestWWW(BaseTest):
         global RATE_LIMITED
         RATE_LIMITED = False
 
+        del NOT_MODIFIED[:]
+        del USER_LOOKUPS[:]
+
+        global ACCESS_TOKEN
+        ACCESS_TOKEN = "dummy"
+        github.MEMO_FRESHNESS = 10 * 60
+
         sandbox.reset()
 
         self.db = db.db
@@ -102,6 +183,8 @@ class TestWWW(BaseTest):
             if not c.startswith("system."):
                 self.db.drop_collection(c)
         db.create_indexes()
+        db.memo_cache.clear()
+        www.fragments.clear()
 
         self.app = webtest.TestApp(www.app)
 
@@ -110,6 +193,17 @@ class TestWWW(BaseTest):
             if not c.startswith("system."):
                 self.db.drop_collection(c)
 
+        # Start our invite thread back up, if a test paused it.
+        worker.stopping.clear()
+        worker.start()
+
+    def pause_invites(self):
+        """Stop our invite thread (until the end of the test), so it
+        doesn't claim invites out from under us.
+        """
+        worker.stop()
+        self.assert_(worker.join(5))
+
     def test_github_auth_without_email(self):
         global GITHUB
         GITHUB = {"/user": {"name": "Mike Dirolf", "login": "mdirolf"},
@@ -138,7 +232,7 @@ class TestWWW(BaseTest):
 
         self.assertIn("My test repo", res)
         res = self.get("/repo/test", res)
-        res = self.submit(res.form)
+        res = self.finish_job(self.submit(res.form))
         self.assertIn("Gitlist has been created", res)
 
         time.sleep(0.2)
@@ -176,12 +270,14 @@ class TestWWW(BaseTest):
 
         self.assertIn("My test repo", res)
         res = self.get("/repo/test", res)
-        res = self.submit(res.form)
+        res = self.finish_job(self.submit(res.form))
         self.assertIn("Gitlist has been created", res)
 
+        time.sleep(0.2)
         mailbox = sandbox.mailbox()
-        self.assertEqual(1, len(mailbox))
+        self.assertEqual(3, len(mailbox))
         self.assertEqual(1, len(mailbox['mike@example.com']))
+        self.assertEqual(1, len(mailbox["another@example.com"]))
 
         GITHUB["/user"] = {"name": "Jim Dirolf",
                            "login": "jdirolf",
@@ -193,7 +289,7 @@ class TestWWW(BaseTest):
 
         self.assertIn("Some crap", res)
         res = self.get("/repo/fiesta/blah", res)
-        res = self.submit(res.form)
+        res = self.finish_job(self.submit(res.form))
         self.assertIn("Gitlist has been created", res)
 
         time.sleep(0.5)
@@ -226,7 +322,7 @@ class TestWWW(BaseTest):
 
         self.assertIn("My test repo", res)
         res = self.get("/repo/test", res)
-        res = self.submit(res.form)
+        res = self.finish_job(self.submit(res.form))
         self.assertIn("Gitlist has been created", res)
 
         time.sleep(0.2)
@@ -256,7 +352,7 @@ class TestWWW(BaseTest):
 
         self.assertIn("My test repo", res)
         res = self.get("/repo/test", res)
-        res = self.submit(res.form)
+        res = self.finish_job(self.submit(res.form))
         self.assertIn("Gitlist has been created", res)
 
         time.sleep(0.2)
@@ -289,3 +385,691 @@ class TestWWW(BaseTest):
         RATE_LIMITED = False
         res = self.get('/', res)
         self.assertIn('Hi <strong>mdirolf', res)
+
+    def test_paginated_lists(self):
+        global GITHUB
+        GITHUB = {"/repos/mdirolf/test/watchers":
+                      [{"login": "w%d" % i} for i in range(250)],
+                  "/repos/mdirolf/test/forks":
+                      [{"owner": {"login": "f%d" % i}} for i in range(101)]}
+
+        with www.app.test_request_context():
+            flask.session["g"] = "dummy"
+            watchers = audience("watchers", "mdirolf", "test")
+            forkers = audience("forkers", "mdirolf", "test")
+
+        self.assertEqual(["w%d" % i for i in range(250)], watchers)
+        self.assertEqual(["f%d" % i for i in range(101)], forkers)
+
+    def test_projected_lists(self):
+        global GITHUB
+        GITHUB = {"/repos/mdirolf/test/watchers":
+                      [{"login": "w1", "url": "https://api.github.com/w1"},
+                       {"gravatar_id": "no login"}],
+                  "/repos/mdirolf/test/forks":
+                      [{"owner": {"login": "f1", "id": 1}}, {"owner": None}]}
+
+        with www.app.test_request_context():
+            flask.session["g"] = "dummy"
+            self.assertEqual(["w1"], audience("watchers", "mdirolf", "test"))
+            self.assertEqual(["f1"], audience("forkers", "mdirolf", "test"))
+
+        # Only the logins are memo-ized.
+        doc = self.db.memo.find_one()
+        self.assertEqual('["w1"]', doc["d"])
+
+    def test_memo_revalidation(self):
+        global GITHUB
+        GITHUB = {"/orgs/fiesta/repos": [{"name": "blah"}]}
+
+        def repo_name():
+            with www.app.test_request_context():
+                flask.session["g"] = "dummy"
+                return github.repos("fiesta")[0]["name"]
+
+        self.assertEqual("blah", repo_name())
+
+        # Fresh memo-ized data doesn't hit GH at all...
+        GITHUB["/orgs/fiesta/repos"] = [{"name": "other"}]
+        self.assertEqual("blah", repo_name())
+        self.assertEqual([], NOT_MODIFIED)
+
+        # ...stale data gets revalidated.
+        github.MEMO_FRESHNESS = 0
+        self.assertEqual("other", repo_name())
+        self.assertEqual([], NOT_MODIFIED)
+        self.assertEqual("other", repo_name())
+        self.assertEqual(["/orgs/fiesta/repos"], NOT_MODIFIED)
+
+    def test_memo_keys(self):
+        GITHUB["/repos/mdirolf/test/watchers"] = [{"login": "testuser"}]
+        GITHUB["/repos/mdirolf/secret/watchers"] = [{"login": "testuser"}]
+        GITHUB["/orgs/fiesta/members"] = [{"login": "testuser"}]
+        # From before memo keys.
+        self.db.memo.insert({"u": "https://api.github.com/user/repos"
+                             "?access_token=dummy", "d": "[]"})
+        db.create_indexes()
+
+        for token in ["dummy", "other"]:
+            with www.app.test_request_context():
+                flask.session["g"] = token
+                audience("watchers", "mdirolf", "test", private=False)
+                audience("watchers", "mdirolf", "secret")
+                audience("members", "fiesta", "blah", "fiesta")
+
+        keys = [doc["u"] for doc in self.db.memo.find()]
+        self.assertEqual(5, len(keys))
+        self.assertIn("*/repos/mdirolf/test/watchers?per_page=100#login", keys)
+        self.assertNotIn("*/repos/mdirolf/secret/watchers?per_page=100#login",
+                         keys)
+        for key in keys:
+            self.assertNotIn("dummy", key)
+            self.assertNotIn("other", key)
+
+    def test_index_partial_org_repos(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [{"login": "broken"}, {"login": "fiesta"}],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/orgs/broken/repos": IOError("socket error", "timed out"),
+                  "/orgs/fiesta/repos": [{"name": "blah",
+                                          "description": "Some crap"}]}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        self.assertIn("My test repo", res)
+        self.assertIn("Some crap", res)
+        self.assertNotIn("broken repos", res)
+
+    def test_index_fragments(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [{"login": "fiesta"}],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/orgs/fiesta/repos": [{"name": "blah",
+                                          "description": "Some crap"}]}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        self.assertIn('<a href="/repo/test">test</a> My test repo', res)
+        self.assertIn('<a href="/repo/fiesta/blah">blah</a> Some crap', res)
+        self.assertEqual(2, len(www.fragments))
+
+        hits = www.fragments.stats["hits"]
+        res = self.get("/", res)
+        self.assertIn("Some crap", res)
+        self.assertEqual(hits + 2, www.fragments.stats["hits"])
+
+        # Once the memo-ized repos change, so does the list.
+        GITHUB["/orgs/fiesta/repos"][0]["description"] = "New crap"
+        github.MEMO_FRESHNESS = 0
+        res = self.get("/", res)
+        self.assertIn("New crap", res)
+        self.assertNotIn("Some crap", res)
+
+    def test_index_etag(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [{"login": "fiesta"}],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/orgs/fiesta/repos": [{"name": "blah",
+                                          "description": "Some crap"}]}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        etag = res.headers["ETag"]
+        self.assertIn("private", res.headers["Cache-Control"])
+
+        res = self.get("/", res, **{"If-None-Match": etag})
+        self.assertEqual(304, res.status_int)
+        self.assertEqual("", res.body)
+        self.assertEqual(etag, res.headers["ETag"])
+
+        GITHUB["/user/repos"].append({"name": "other",
+                                      "description": "Another repo"})
+        res = self.get("/", res, **{"If-None-Match": etag})
+        self.assertEqual(200, res.status_int)
+        self.assertIn("Another repo", res)
+        self.assertNotEqual(etag, res.headers["ETag"])
+
+        # A deploy changes every page's ETag.
+        etag = res.headers["ETag"]
+        deploy_version = www.DEPLOY_VERSION
+        www.DEPLOY_VERSION = "new"
+        try:
+            res = self.get("/", res, **{"If-None-Match": etag})
+        finally:
+            www.DEPLOY_VERSION = deploy_version
+        self.assertEqual(200, res.status_int)
+        self.assertNotEqual(etag, res.headers["ETag"])
+
+    def test_repo_etag(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}]}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.get("/repo/test", res)
+        etag = res.headers["ETag"]
+        res = self.get("/repo/test", res, **{"If-None-Match": etag})
+        self.assertEqual(304, res.status_int)
+
+        # Somebody else made a list for it.
+        db.new_list("test", "another", "g1")
+        res = self.get("/repo/test", res, **{"If-None-Match": etag})
+        self.assertEqual(200, res.status_int)
+        self.assertIn("another/test", res)
+        etag = res.headers["ETag"]
+
+        # Flashes always get the whole page.
+        created = coding.urlenc_int(int(time.time()) - 2 * 60 * 60)
+        form = res.form
+        form["x"] = created + "|" + sign.no_time("createdummy" + created)
+        res = form.submit(headers={"REFERER": res.request.url})
+        res = self.get("/repo/test", res, **{"If-None-Match": etag})
+        self.assertEqual(200, res.status_int)
+        self.assertIn("session timed out", res)
+
+        # Logging in again gets a new token, so the form needs a new
+        # XSRF token too.
+        etag = self.get("/repo/test", res).headers["ETag"]
+        global ACCESS_TOKEN
+        ACCESS_TOKEN = "another"
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.get("/repo/test", res, **{"If-None-Match": etag})
+        self.assertEqual(200, res.status_int)
+        self.assertNotEqual(etag, res.headers["ETag"])
+        res = self.finish_job(self.submit(res.form))
+        self.assertNotIn("Bad XSRF token", res)
+
+    def test_index_timeout(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [{"login": "fiesta"}],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/orgs/fiesta/repos": [{"name": "blah",
+                                          "description": "Some crap"}]}
+        res = self.follow(self.get("/auth/github?code=dummy"))
+
+        current_user = github.current_user
+        github.current_user = lambda: time.sleep(0.5)
+        github.CALL_TIMEOUT = 0.1
+        try:
+            start = time.time()
+            res = self.get("/", res, status=503)
+            self.assertIn("GitHub is slow", res)
+            self.assert_(time.time() - start < 0.4)
+        finally:
+            github.current_user = current_user
+            github.CALL_TIMEOUT = 10
+
+    def test_per_request_calls(self):
+        GITHUB["/user"] = {"login": "mdirolf", "email": "mike@example.com"}
+        GITHUB["/user/orgs"] = []
+
+        with www.app.test_request_context():
+            flask.session["g"] = "dummy"
+            github.current_user()
+            github.orgs()
+            github.submit(github.current_user).result()
+            github.orgs()
+            self.assertEqual({"upstream": 2, "deduped": 2},
+                             github.call_summary())
+
+    def test_shared_rate_limit(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": []}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        self.assertIn('Hi <strong>mdirolf', res)
+
+        # Another process used up our budget.
+        bucket = "user/" + github.token_scope("dummy")
+        db.sync_rate_limit(bucket, 0, time.time() + 60)
+        res = self.follow(self.get("/", res))
+        self.assertIn('hit the GitHub API rate limit', res)
+
+        # The budget's reset.
+        db.sync_rate_limit(bucket, 0, time.time() - 1)
+        res = self.get("/", res)
+        self.assertIn('Hi <strong>mdirolf', res)
+        self.assertEqual(github.RATE_LIMITS["user"][0] - 3,
+                         self.db.ratelimit.find_one({"_id": bucket})["remaining"])
+
+    def test_window_start_race(self):
+        # Somebody else starts the window between our two attempts.
+        ratelimit = db.db.ratelimit
+        find_and_modify = ratelimit.find_and_modify
+        def lose_race(spec, *args, **kwargs):
+            del ratelimit.find_and_modify
+            find_and_modify({"_id": "race"},
+                            {"$set": {"remaining": 9,
+                                      "reset": time.time() + 60}},
+                            upsert=True)
+            return None
+        ratelimit.find_and_modify = lose_race
+        try:
+            self.assertEqual(0, db.take_call("race", 10, 60))
+        finally:
+            ratelimit.__dict__.pop("find_and_modify", None)
+        self.assertEqual(8,
+                         self.db.ratelimit.find_one({"_id": "race"})["remaining"])
+
+    def test_invites_use_saved_users(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/repos/mdirolf/test/collaborators": [{"login": "testuser"},
+                                                        {"login": "newbie"}],
+                  "/repos/mdirolf/test/contributors": [],
+                  "/repos/mdirolf/test/forks": [],
+                  "/repos/mdirolf/test/watchers": [],
+                  "_user/newbie": {"user": {"email": "newbie@example.com"}}}
+        db.save_user("testuser", "test@example.com", "Test User")
+        metrics.reset()
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.get("/repo/test", res)
+        res = self.finish_job(self.submit(res.form))
+        self.assertIn("Gitlist has been created", res)
+
+        time.sleep(0.2)
+        mailbox = sandbox.mailbox()
+        self.assertEqual(1, len(mailbox["test@example.com"]))
+        self.assertEqual(1, len(mailbox["newbie@example.com"]))
+        self.assertEqual(["newbie"], USER_LOOKUPS)
+        self.assertEqual("newbie@example.com", db.user("newbie")["email"])
+        self.assertEqual(1, metrics.counter("github_user_info",
+                                            source="saved"))
+        self.assertEqual(1, metrics.counter("github_user_info",
+                                            source="github"))
+
+    def test_failed_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}]}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.get("/repo/test", res)
+        GITHUB["/user/repos"] = []
+        res = self.finish_job(self.submit(res.form))
+        self.assertIn("couldn't create your Gitlist: No matching repo", res)
+
+        res = self.get(res.request.url + ".json", res)
+        self.assertEqual("failed", res.json["status"])
+        self.assertEqual(None, res.json["group_id"])
+
+    def test_resumed_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/repos/mdirolf/test/collaborators": [],
+                  "/repos/mdirolf/test/contributors": [],
+                  "/repos/mdirolf/test/forks": [],
+                  "/repos/mdirolf/test/watchers":
+                      [{"login": "w%d" % i} for i in range(250)]}
+
+        # A job that died after the first two pages of watchers.
+        job_id = db.new_job(github.token_scope("dummy"), repo="test", org=None)
+        self.db.jobs.update({"_id": job_id},
+                            {"$set": {"status": "running", "lease": 0,
+                                      "held_since": time.time(),
+                                      "cursors": {"collaborators": 0,
+                                                  "contributors": 0,
+                                                  "forkers": 0,
+                                                  "watchers": 3}}})
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.finish_job(self.get("/job/%s" % job_id, res))
+        self.assertIn("Gitlist has been created", res)
+
+        res = self.get(res.request.url + ".json", res)
+        self.assertEqual(50, res.json["audience"])
+        self.assertEqual(50, res.json["invites"])
+        self.assertEqual(1, self.db.lists.count())
+
+        # Finished jobs aren't run again.
+        self.assertEqual(None, db.claim_job(job_id, 60))
+
+    def test_orphaned_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/repos/mdirolf/test/collaborators": [{"login": "a"}],
+                  "/repos/mdirolf/test/contributors": [],
+                  "/repos/mdirolf/test/forks": [],
+                  "/repos/mdirolf/test/watchers": []}
+
+        # A job queued in a process that died before it got to it.
+        job_id = db.new_job(github.token_scope("dummy"), repo="test", org=None)
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.finish_job(self.get("/job/%s" % job_id, res))
+        self.assertIn("Gitlist has been created", res)
+        self.assertEqual(1, self.db.lists.count())
+
+    def test_stale_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/repos/mdirolf/test/collaborators": [],
+                  "/repos/mdirolf/test/contributors": [],
+                  "/repos/mdirolf/test/forks": [],
+                  "/repos/mdirolf/test/watchers":
+                      [{"login": "w%d" % i} for i in range(120)]}
+
+        # A job that died long enough ago that its held invites might
+        # have started to expire.
+        job_id = db.new_job(github.token_scope("dummy"), repo="test", org=None)
+        self.db.jobs.update({"_id": job_id},
+                            {"$set": {"status": "running", "lease": 0,
+                                      "held_since": time.time() - www.REGATHER_AFTER - 1,
+                                      "cursors": {"collaborators": 0,
+                                                  "contributors": 0,
+                                                  "forkers": 0,
+                                                  "watchers": 2}}})
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["gone"], job_id, held=True)
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.finish_job(self.get("/job/%s" % job_id, res))
+        self.assertIn("Gitlist has been created", res)
+        res = self.get(res.request.url + ".json", res)
+        self.assertEqual(120, res.json["audience"])
+
+    def test_running_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": []}
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        job_id = db.new_job(github.token_scope("dummy"), repo="test", org=None)
+        self.db.jobs.update({"_id": job_id},
+                            {"$set": {"status": "running", "audience": None,
+                                      "lease": time.time() + 60}})
+
+        res = self.get("/job/%s" % job_id, res)
+        self.assertIn("Hang on", res)
+        self.assertNotIn("None", res)
+        self.assertIn("forkers and watchers: ...", res)
+
+        self.db.jobs.update({"_id": job_id}, {"$set": {"audience": 3}})
+        res = self.get("/job/%s" % job_id, res)
+        self.assertIn("found <strong>3</strong>", res)
+
+    def test_lost_job(self):
+        job_id = db.new_job(github.token_scope("dummy"), repo="test", org=None)
+        first = db.claim_job(job_id, 0)
+        db.renew_job(first, -1, **{"cursors.watchers": 2})
+
+        # Our lease ran out, and somebody else picked the job up.
+        second = db.claim_job(job_id, 60)
+        self.assertEqual(2, second["cursors"]["watchers"])
+        self.assertRaises(errors.JobLost, db.renew_job, first, 60,
+                          status="failed")
+        db.renew_job(second, 60, **{"cursors.watchers": 3})
+        self.assertEqual("running", db.job(job_id)["status"])
+        self.assertEqual(3, db.job(job_id)["cursors"]["watchers"])
+
+    def test_retried_job(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [],
+                  "/user/repos": [{"name": "test",
+                                   "description": "My test repo"}],
+                  "/repos/mdirolf/test/collaborators": [{"login": "a"}],
+                  "/repos/mdirolf/test/contributors": [],
+                  "/repos/mdirolf/test/forks":
+                      IOError("socket error", "timed out"),
+                  "/repos/mdirolf/test/watchers": []}
+
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        res = self.get("/repo/test", res)
+        form = res.form
+        failed = self.finish_job(self.submit(form))
+        self.assertIn("couldn't create your Gitlist", failed)
+        self.assertEqual(0, self.db.jobs.find_one()["cursors"]["contributors"])
+        self.assertEqual(1, db.held_invites(self.db.jobs.find_one()["_id"]))
+
+        GITHUB["/repos/mdirolf/test/forks"] = [{"owner": {"login": "b"}}]
+        res = self.finish_job(self.submit(form))
+        self.assertIn("Gitlist has been created", res)
+        self.assertEqual(failed.request.url, res.request.url)
+        self.assertEqual(1, self.db.jobs.count())
+        self.assertEqual(2, self.db.jobs.find_one()["invites"])
+
+    def test_held_invites(self):
+        self.pause_invites()
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b"], "job", held=True)
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["b"], "other", 60)
+        self.assertEqual(2, db.held_invites("job"))
+        self.assertEqual(1, db.invite_queue()["depth"])
+        self.assertEqual(2, self.db.invites.find({"x": {"$exists": True}}).count())
+
+        # Claiming b's other invite doesn't claim the held one.
+        self.db.invites.update({"group_id": "other"},
+                               {"$set": {"lease": 0}}, multi=True)
+        self.assertEqual(["other"],
+                         [i["group_id"] for i in db.claim_invites(10, 60)])
+
+        db.release_invites("job", "group", 60)
+        self.assertEqual(0, db.held_invites("job"))
+        self.assertEqual(2, self.db.invites.find({"group_id": "group"}).count())
+        self.assertEqual(0, self.db.invites.find({"x": {"$exists": True}}).count())
+        self.assertEqual(3, db.invite_queue()["depth"])
+
+    def test_invite_leases(self):
+        self.pause_invites()
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b", "c"], "nope")
+
+        # Nobody can claim leased invites.
+        self.db.invites.update({}, {"$set": {"lease": time.time() + 60}},
+                               multi=True)
+        self.assertEqual([], db.claim_invites(10, 60))
+        self.db.invites.update({}, {"$set": {"lease": 0}}, multi=True)
+
+        first = db.claim_invites(2, 0.1)
+        self.assertEqual(2, len(first))
+        self.assertEqual(1, len(db.claim_invites(2, 60)))
+        self.assertEqual([], db.claim_invites(2, 60))
+        db.ack_invite(first[0])
+
+        # The other one wasn't acked, so it goes back on the queue.
+        time.sleep(0.2)
+        self.assertEqual([first[1]["username"]],
+                         [i["username"] for i in db.claim_invites(2, 60)])
+        self.assertEqual(2, self.db.invites.count())
+
+    def test_fiesta_handoff(self):
+        self.pause_invites()
+        group = sandbox.create_group(default_name="test")
+        for username in ["a", "b", "c"]:
+            db.save_user(username, username + "@example.com", username)
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b", "c"], group.id)
+
+        # Only one add at a time gets handed to Fiesta.
+        worker.stopping.clear()
+        adding = []
+        add_member = worker.add_member
+        def slow_add_member(invites, *args, **kwargs):
+            adding.append(invites[0]["username"])
+            self.assertEqual(1, len(adding))
+            time.sleep(0.05)
+            adding.pop()
+            add_member(invites, *args, **kwargs)
+        worker.add_member = slow_add_member
+        worker.fiesta_slots = threading.Semaphore(1)
+        try:
+            self.assertEqual(3, worker.SendInvites().send_batch())
+            self.assert_(worker.fiesta_pool.join(5))
+        finally:
+            worker.add_member = add_member
+            worker.fiesta_slots = threading.Semaphore(worker.FIESTA_WORKERS)
+        self.assertEqual(3, len(sandbox.mailbox()))
+        self.assertEqual(0, self.db.invites.count())
+
+    def test_stopping_unclaims_invites(self):
+        self.pause_invites()
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b"], "nope")
+
+        # We've been told to stop, so nothing gets sent.
+        self.assertEqual(2, worker.SendInvites().send_batch())
+        self.assertEqual([], USER_LOOKUPS)
+        self.assertEqual([(0, 0), (0, 0)],
+                         [(i["lease"], i["tries"])
+                          for i in self.db.invites.find()])
+
+    def test_renew_invites(self):
+        self.pause_invites()
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b"], "nope")
+        invites = db.claim_invites(10, 0.1)
+        self.assertEqual(2, len(invites))
+        self.assertEqual(invites, db.renew_invites(invites, 60))
+        self.assertEqual([], db.claim_invites(10, 60))
+
+        # Once our lease is up, somebody else can take them.
+        db.renew_invites(invites, -1)
+        db.ack_invite(db.claim_invites(1, 60)[0])
+        self.assertEqual([invites[1]], db.renew_invites(invites, 60))
+
+    def test_claim_order(self):
+        self.pause_invites()
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a"], "nope")
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["b"], "nope")
+
+        # b has been claimable for longer, so it goes first.
+        now = time.time()
+        self.db.invites.update({"username": "a"}, {"$set": {"lease": now - 1}})
+        self.db.invites.update({"username": "b"}, {"$set": {"lease": now - 10}})
+        self.assertEqual(["b"],
+                         [i["username"] for i in db.claim_invites(1, 60)])
+        self.assertEqual(2, db.invite_queue()["depth"])
+        self.assert_(db.invite_queue()["oldest"] >= 0)
+
+    def test_invites_are_unique(self):
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b"], "nope", 60)
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["b", "c"], "nope", 60)
+        self.assertEqual(["a", "b", "c"],
+                         sorted(self.db.invites.distinct("username")))
+        self.assertEqual(3, self.db.invites.count())
+
+    def test_coalesced_invites(self):
+        metrics.reset()
+        db.save_user("testuser", "test@example.com", "Test User")
+        first = sandbox.create_group(default_name="first")
+        second = sandbox.create_group(default_name="second")
+        db.pending_invites("first", "https://github.com/mdirolf/first",
+                           "mdirolf", ["testuser"], first.id, 0.1)
+        db.pending_invites("second", "https://github.com/jdoe/second",
+                           "jdoe", ["testuser"], second.id, 0.1)
+        worker.wake_invites()
+
+        time.sleep(0.3)
+        mailbox = sandbox.mailbox()
+        self.assertEqual(1, len(mailbox["test@example.com"]))
+        message = mailbox["test@example.com"][0]["text"]
+        self.assertIn("[first](https://github.com/mdirolf/first)", message)
+        self.assertIn("[second](https://github.com/jdoe/second)", message)
+        self.assertIn("$invite_url", message)
+        self.assertIn("https://fiesta.cc/list/", message)
+        self.assertEqual(0, self.db.invites.count())
+        self.assertEqual(1, metrics.counter("invites", result="sent"))
+        self.assertEqual(1, metrics.counter("invites", result="linked"))
+
+    def test_db_metrics(self):
+        metrics.reset()
+        db.new_list("test", "mdirolf", "g1")
+        db.new_list("test", "jdoe", "g2")
+        self.assertEqual(["g2"], [l["group_id"] for l in
+                                  db.existing_not_own("test", "mdirolf")])
+        self.assertEqual(1, metrics.counter("db_calls",
+                                            fn="existing_not_own"))
+        self.assertEqual(2, metrics.counter("db_calls", fn="new_list"))
+        self.assertEqual(2, metrics.histogram("db_seconds",
+                                              fn="new_list").count)
+
+    def test_metrics_endpoint(self):
+        global GITHUB
+        GITHUB = {"/user": {"name": "Mike Dirolf",
+                            "login": "mdirolf",
+                            "email": "mike@example.com"},
+                  "/user/orgs": [{"login": "fiesta"}],
+                  "/user/repos": [],
+                  "/orgs/fiesta/repos": []}
+        metrics.reset()
+        res = self.follow(self.get("/auth/github?code=dummy"))
+        self.assertIn('Hi <strong>mdirolf', res)
+        db.pending_invites("test", "https://github.com/mdirolf/test",
+                           "mdirolf", ["a", "b"], "nope", 60)
+
+        res = self.get("/metrics")
+        self.assertStartsWith(res.headers["Content-Type"], "text/plain")
+        lines = res.body.splitlines()
+        self.assertIn('gitlists_github_calls{endpoint="/user",status="200"} 1.0',
+                      lines)
+        self.assertIn('gitlists_github_calls{endpoint="/orgs/:org/repos",'
+                      'status="200"} 1.0', lines)
+        self.assertIn('gitlists_github_seconds_count{endpoint="/user"} 1',
+                      lines)
+        self.assertIn("gitlists_invite_queue_depth 2.0", lines)
+        self.assertIn("gitlists_invite_queue_ready 0.0", lines)
+        self.assertEqual(1, metrics.counter("db_calls", fn="invite_queue"))
+
+        # Pre-forked workers label their metrics.
+        www.worker_number = 2
+        try:
+            lines = self.get("/metrics").body.splitlines()
+        finally:
+            www.worker_number = None
+        self.assertIn('gitlists_invite_queue_depth{worker="2"} 2.0', lines)
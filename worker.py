@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import fiesta
+
+import cache
+import daemon
+import db
+import github
+import metrics
+import pool
+import settings
+
+
+fiesta_api = fiesta.FiestaAPI(settings.fiesta_id,
+                              settings.fiesta_secret,
+                              "gitlists.com")
+
+
+# Set when there might be new invites to send. We also check the queue
+# every SLEEP_INTERVAL seconds, in case we missed a wake-up.
+invites_waiting = threading.Event()
+SLEEP_INTERVAL = 60
+
+# Set when we should stop claiming invites (see `stop`).
+stopping = threading.Event()
+
+# How many invites we claim at once, and for how long (in seconds). An
+# invite that isn't acked by then goes back on the queue.
+INVITE_BATCH = 100
+INVITE_LEASE = 15 * 60
+
+# How long (in seconds) new invites are held, so any more invites for
+# the same users can be sent along with them.
+COALESCE_WINDOW = 5 * 60
+
+# Adding members to Fiesta groups happens on its own pool, so it never
+# waits on GH (or vice versa). We only hand the pool as many adds as it
+# has workers, so claimed invites wait in their batch (not in the pool's
+# queue) until Fiesta can take them.
+FIESTA_WORKERS = 4
+fiesta_pool = pool.Pool(FIESTA_WORKERS)
+fiesta_slots = threading.Semaphore(FIESTA_WORKERS)
+fiesta_groups = cache.LRU(100, 100)
+
+
+def wake_invites():
+    invites_waiting.set()
+    db.signal_invites()
+
+
+def invite_queue():
+    """Gauges for the invite queue (see db.invite_queue).
+    """
+    queue = db.invite_queue()
+    return {"invite_queue_depth": queue["depth"],
+            "invite_queue_ready": queue["ready"],
+            "invite_queue_oldest_seconds": queue["oldest"]}
+
+
+metrics.collect(invite_queue)
+
+
+def fiesta_group(group_id):
+    group = fiesta_groups.get(group_id)
+    if not group:
+        group = fiesta.FiestaGroup.from_id(fiesta_api, group_id)
+        fiesta_groups.put(group_id, group)
+    return group
+
+
+def add_member(invites, *args, **kwargs):
+    """Add a member to the first of `invites`' groups, acking all of them.
+
+    Only the first invite is a Fiesta invite, the rest are links to their
+    list pages in the same email (see `digest_message`), so we count
+    those as "linked" rather than "sent". Gives back the slot
+    `SendInvites.invite` took for it.
+    """
+    group_id = invites[0]["group_id"]
+    try:
+        with metrics.timed("fiesta_seconds", call="add_member"):
+            fiesta_group(group_id).add_member(*args, **kwargs)
+    except Exception:
+        logging.exception("Couldn't add member to %s" % group_id)
+        metrics.inc("invites", len(invites), result="failed")
+        return
+    finally:
+        fiesta_slots.release()
+    for invite in invites:
+        db.ack_invite(invite)
+    metrics.inc("invites", result="sent")
+    if len(invites) > 1:
+        metrics.inc("invites", len(invites) - 1, result="linked")
+    metrics.inc("invite_emails")
+
+
+def invite_message(invite):
+    repo_name = invite["repo_name"]
+    github_url = invite["github_url"]
+    inviter = invite["inviter"]
+
+    return {"subject": "Invitation to %s@gitlists.com" % repo_name,
+            "markdown": """
+[%s](%s) invited you to a [Gitlist](https://gitlists.com) for [%s](%s). Gitlists are dead-simple mailing lists for GitHub projects.
+
+[Click here]($invite_url) to join the list. If you don't want to join, just ignore this message.
+
+Have a great day!
+""" % (inviter, "http://github.com/" + inviter, repo_name, github_url)}
+
+
+def digest_message(invites):
+    """One message for all of `invites` (to the same user).
+
+    Fiesta sends the invite for the first one; the rest link to their
+    list pages, which is where anybody can join. So for those lists
+    it's a weaker invite: the user has to find the join button on the
+    list page, rather than just accepting. We don't add them to the
+    other groups with send_invite=False, because that would subscribe
+    them to lists they never agreed to.
+    """
+    lists = []
+    for (i, invite) in enumerate(invites):
+        inviter = invite["inviter"]
+        join_url = i and "https://fiesta.cc/list/%s" % invite["group_id"] \
+            or "$invite_url"
+        lists.append("* [%s@gitlists.com](%s) for [%s](%s), from [%s](%s)" %
+                     (invite["repo_name"], join_url, invite["repo_name"],
+                      invite["github_url"], inviter,
+                      "http://github.com/" + inviter))
+
+    return {"subject": "Invitations to %d Gitlists" % len(invites),
+            "markdown": """
+You've been invited to some [Gitlists](https://gitlists.com). Gitlists are dead-simple mailing lists for GitHub projects.
+
+%s
+
+Click on a list to join it. If you don't want to join, just ignore this message.
+
+Have a great day!
+""" % "\n".join(lists)}
+
+
+class SendInvites(threading.Thread):
+    '''
+    We send invites from a separate thread, so looking up users can
+    wait on GH's rate limit (shared by all of our processes, see
+    github.throttle) without holding up any requests.
+
+    Invites are held for COALESCE_WINDOW seconds after they're queued,
+    and all of a user's invites are sent together, so somebody who's
+    invited to a bunch of lists in a row gets a single email (with a
+    Fiesta invite to the first list, and links to the rest - see
+    `digest_message`).
+    '''
+
+    def run(self):
+        while not stopping.isSet():
+            invites_waiting.clear()
+            if not self.send_batch():
+                invites_waiting.wait(self.wait())
+
+    def send_batch(self):
+        """Claim and send a batch of invites, returning how many we claimed.
+        """
+        invites = db.claim_invites(INVITE_BATCH, INVITE_LEASE)
+        if not invites:
+            return 0
+
+        metrics.inc("invites_claimed", len(invites))
+        by_user = {}
+        for invite in invites:
+            by_user.setdefault(invite["username"], []).append(invite)
+
+        # Only users we haven't seen before cost us a GH call.
+        users = db.users(by_user)
+        metrics.inc("github_user_info", len(users), source="saved")
+        looked_up = {}
+        by_user = by_user.items()
+        for (i, (username, user_invites)) in enumerate(by_user):
+            if stopping.isSet():
+                # Leave the rest for whoever's still running.
+                db.unclaim_invites(sum([rest for (_, rest) in by_user[i:]],
+                                       []))
+                break
+            try:
+                if username not in users:
+                    metrics.inc("github_user_info", source="github")
+                    users[username] = looked_up[username] = \
+                        github.lookup_user(username)
+                self.invite(user_invites, users[username])
+            except Exception:
+                # They'll be retried once their lease is up.
+                logging.exception("Couldn't invite %r" % user_invites)
+                metrics.inc("invites", len(user_invites), result="failed")
+        db.save_users(looked_up)
+        return len(invites)
+
+    def wait(self):
+        """How long to wait for invites: until the next held one is ready.
+        """
+        next_at = db.next_claimable()
+        if next_at is None:
+            return SLEEP_INTERVAL
+        return min(SLEEP_INTERVAL, max(next_at - time.time(), 0.01))
+
+    def invite(self, invites, user):
+        if not user.get("email", None):
+            for invite in invites:
+                db.ack_invite(invite)
+            metrics.inc("invites", len(invites), result="no_email")
+            return
+
+        # Wait for Fiesta to have room, then make sure our lease lasts
+        # until it's done (we might have been waiting a while).
+        fiesta_slots.acquire()
+        try:
+            invites = db.renew_invites(invites, INVITE_LEASE)
+            if not invites:
+                fiesta_slots.release()
+                return
+
+            if len(invites) == 1:
+                welcome_message = invite_message(invites[0])
+            else:
+                welcome_message = digest_message(invites)
+
+            fiesta_pool.submit(add_member, invites, user["email"],
+                               display_name=user.get("name", ""),
+                               welcome_message=welcome_message,
+                               send_invite=True)
+        except Exception:
+            fiesta_slots.release()
+            raise
+
+
+class InviteSignals(threading.Thread):
+    '''
+    Wakes up our invite thread when another process queues invites.
+    '''
+
+    def run(self):
+        for _ in db.tail_signals():
+            invites_waiting.set()
+
+
+# The process our invite threads were started in (threads don't survive
+# a fork), and the thread sending invites.
+_started_pid = None
+_start_lock = threading.Lock()
+_sender = None
+
+
+def start():
+    """Start this process's invite threads (if they aren't running yet).
+
+    Once we've been stopped this does nothing until `stopping` is
+    cleared, so a request that comes in while we drain doesn't start
+    claiming invites again.
+    """
+    global _started_pid, _sender
+    with _start_lock:
+        if _started_pid != os.getpid():
+            signals = InviteSignals()
+            signals.daemon = True
+            signals.start()
+            _started_pid = os.getpid()
+            _sender = None
+        if stopping.isSet() or (_sender and _sender.isAlive()):
+            return
+        _sender = SendInvites()
+        _sender.daemon = True
+        _sender.start()
+
+
+def stop():
+    """Stop claiming invites. The ones we've claimed are still sent.
+    """
+    stopping.set()
+    invites_waiting.set()
+
+
+def join(timeout):
+    """Wait (up to `timeout` seconds) for `stop` to take effect.
+
+    Returns whether we're done with every invite we claimed. Any we
+    aren't go back on the queue when their leases are up.
+    """
+    deadline = time.time() + timeout
+    if _sender and _started_pid == os.getpid():
+        _sender.join(max(0, deadline - time.time()))
+        if _sender.isAlive():
+            return False
+    return fiesta_pool.join(max(0, deadline - time.time()))
+
+
+def stop_on_sigterm(timeout):
+    """Stop (after waiting up to `timeout` seconds) when we get a SIGTERM.
+    """
+    stopped = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.append(signum))
+    while not stopped:
+        time.sleep(1)
+    stop()
+    if not join(timeout):
+        logging.error("Stopped before sending all of our claimed invites")
+
+
+def serve_metrics(number):
+    """Serve this process's metrics, if `worker_metrics_port` is set.
+
+    Worker `number` serves them on `worker_metrics_port` + `number`.
+    """
+    port = getattr(settings, "worker_metrics_port", None)
+    if port is None:
+        return None
+    return metrics.serve(port + number, process="worker", worker=number)
+
+
+class WorkerDaemon(daemon.Daemon):
+    def __init__(self, number, *args, **kwargs):
+        self.number = number
+        return daemon.Daemon.__init__(self, *args, **kwargs)
+
+    def run(self):
+        db.create_indexes()
+        listener = serve_metrics(self.number)
+        start()
+        stop_on_sigterm(getattr(settings, "drain_timeout",
+                                daemon.DRAIN_TIMEOUT))
+        if listener:
+            listener.stop()
+
+
+if __name__ == '__main__':
+    # Run as many of these (on as many hosts) as you like, each with
+    # its own number.
+    number = 0
+
+    if len(sys.argv) > 2:
+        number = int(sys.argv[2])
+    if settings.env == "prod":
+        daemon.go(WorkerDaemon(number,
+                               "/tmp/gitlists-worker-%s.pid" % number))
+    else:
+        db.create_indexes()
+        serve_metrics(number)
+        start()
+        while True:
+            time.sleep(SLEEP_INTERVAL)
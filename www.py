@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import glob
+import hashlib
 import json
+import logging
+import os
 import re
 import sys
-import threading
 import time
 import urlparse
 
@@ -12,13 +15,17 @@ import fiesta
 import flask
 from paste.exceptions.errormiddleware import ErrorMiddleware
 
+import cache
 import daemon
 import db
 import github
 import errors
+import metrics
+import pool
 import settings
 import sign
 import werkzeug_monkeypatch
+import worker
 
 
 fiesta_api = fiesta.FiestaAPI(settings.fiesta_id,
@@ -38,60 +45,77 @@ if settings.env == "prod":
                                    smtp_server=settings.relay_host)
 
 
-# GH API rate is 60 calls per minute, but we run this from two
-# processes, so each gets 30 per minute.
-SLEEP_INTERVAL = 2.1
+# Lists are created in the background, on this pool.
+JOB_WORKERS = 4
+job_pool = pool.Pool(JOB_WORKERS)
 
-class SendInvites(threading.Thread):
-    '''
-    We send invites from a separate thread to try to avoid going over
-    GH's rate limit (60 calls per minute for V2 API).
-    '''
+# Rendered repo lists for the index page, by (user, org, version of the
+# repos). A new version (see github.versioned_request) means a new key,
+# so stale lists just age out.
+FRAGMENT_ITEMS = 1000
+FRAGMENT_BYTES = 16 * 1024 * 1024
+fragments = cache.LRU(FRAGMENT_ITEMS, FRAGMENT_BYTES)
 
-    def run(self):
-        while True:
-            invite = db.next_invite()
-            if not invite:
-                time.sleep(SLEEP_INTERVAL)
-                continue
-
-            repo_name = invite["repo_name"]
-            github_url = invite["github_url"]
-            inviter = invite["inviter"]
-            username = invite["username"]
-            group = fiesta.FiestaGroup.from_id(fiesta_api, invite["group_id"])
-
-            welcome_message = {"subject": "Invitation to %s@gitlists.com" % repo_name,
-                               "markdown": """
-[%s](%s) invited you to a [Gitlist](https://gitlists.com) for [%s](%s). Gitlists are dead-simple mailing lists for GitHub projects.
-
-[Click here]($invite_url) to join the list. If you don't want to join, just ignore this message.
-
-Have a great day!
-""" % (inviter, "http://github.com/" + inviter, repo_name, github_url)}
-
-            user, cache = github.user_info(username)
-            if user.get("email", None):
-                group.add_member(user["email"],
-                                 display_name=user.get("name", ""),
-                                 welcome_message=welcome_message,
-                                 send_invite=True)
-
-            if not cache:
-                time.sleep(SLEEP_INTERVAL)
-
-
-# Invite thread
-send_invites = SendInvites()
-send_invites.daemon = True
-send_invites.start()
+def code_version():
+    """A version of our code, templates and static files, which changes
+    whenever any of them do.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = glob.glob(os.path.join(root, "*.py")) + \
+        glob.glob(os.path.join(root, "templates", "*")) + \
+        glob.glob(os.path.join(root, "static", "*", "*"))
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        digest.update(os.path.relpath(path, root))
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Part of every ETag, so a deploy that changes how pages look doesn't
+# leave clients with 304s for the old ones. Set `deploy_version` in
+# settings to use your own (a git sha, say).
+DEPLOY_VERSION = getattr(settings, "deploy_version", None) or code_version()
+
+# Pages with forms on them carry XSRF tokens, so their ETags change every
+# XSRF_BUCKET seconds. That way a page we answer with a 304 never has a
+# token older than that.
+XSRF_BUCKET = 5 * 60
+
+# A running job holds a lease on itself for JOB_LEASE seconds at a time,
+# renewed as it makes progress. If its process dies the job is resumed
+# (from its last checkpoint) once the lease is up. Calls to Fiesta can't
+# be checkpointed part way, so they get FIESTA_LEASE seconds.
+JOB_LEASE = 60
+FIESTA_LEASE = 5 * 60
+
+# A job's held invites expire (see db.HELD_TTL), so a job resumed more
+# than REGATHER_AFTER seconds after it started holding them throws them
+# out and finds its audience again.
+REGATHER_AFTER = db.HELD_TTL / 2
+
+# Whether this process sends invites too (rather than leaving them to
+# worker.py). When we're pre-forked only worker 0 does.
+invite_threads = getattr(settings, "invite_thread", True)
+
+# In prod, WORKERS processes share our listening socket, each handling
+# requests on THREADS threads. When they're stopped they get
+# DRAIN_TIMEOUT seconds to finish their requests, jobs and invites.
+WORKERS = getattr(settings, "workers", 4)
+THREADS = getattr(settings, "threads", 8)
+DRAIN_TIMEOUT = getattr(settings, "drain_timeout", daemon.DRAIN_TIMEOUT)
+
+# Which of those workers we are (None when we aren't pre-forked). Each
+# worker's metrics are its own, so they're labeled with its number - and
+# with `metrics_port` set, worker N also serves them on that port plus N,
+# so they can all be scraped (any worker might answer /metrics).
+worker_number = None
 
 
 def gen_xsrf(actions):
-    xsrf = {}
-    for action in actions:
-        xsrf[action] = sign.sign(action + flask.session["g"])
-    return {"xsrf": xsrf}
+    token = flask.session["g"]
+    sigs = sign.sign_many([action + token for action in actions])
+    return {"xsrf": dict(zip(actions, sigs))}
 
 
 def until(s, x):
@@ -127,24 +151,112 @@ def check_xsrf(action, timeout=60*60):
     return decorator.decorator(check_xsrf)
 
 
+@app.before_request
+def start_invite_threads():
+    if invite_threads:
+        worker.start()
+
+
+@app.after_request
+def log_github_calls(response):
+    summary = github.call_summary()
+    logging.debug("%s %s: %d GitHub calls (%d deduped)", flask.request.method,
+                  flask.request.path, summary["upstream"], summary["deduped"])
+    if app.debug:
+        response.headers["X-GitHub-Calls"] = "%(upstream)d; deduped=%(deduped)d" % summary
+    return response
+
+
 @app.route("/rate_limited")
 def rate_limited():
     return flask.render_template("rate_limited.html")
 
 
+def etag(*versions):
+    """A strong ETag for a page built from data with `versions`, by this
+    deploy (see DEPLOY_VERSION).
+
+    None if any of the versions are unknown.
+    """
+    if None in versions:
+        return None
+    return hashlib.sha1(json.dumps((DEPLOY_VERSION,) + versions)).hexdigest()
+
+
+def conditional(tag, render):
+    """The response for a page with ETag `tag`: a 304 if the client
+    already has it, otherwise `render()`.
+
+    Pending flashes have to be rendered, so they always get the page.
+    """
+    if tag and "_flashes" not in flask.session and \
+            flask.request.if_none_match.contains(tag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.make_response(render())
+    if tag:
+        response.set_etag(tag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def repo_list(user, repos, version, org=None):
+    """`repos` (`org`'s, or else `user`'s own) rendered as a list.
+
+    Cached in `fragments` for as long as `version` stays the same.
+    """
+    key = (user["login"], org and org["login"], version)
+    html = version and fragments.get(key)
+    if html is None:
+        html = flask.render_template("repo_list.html", repos=repos, org=org)
+        if version:
+            fragments.put(key, html, len(html))
+    return flask.Markup(html)
+
+
+def render_index(user, repos, orgs, org_repos):
+    """The logged in index page. `repos` and each of `org_repos` are
+    (repos, version) pairs, or None for org repos we couldn't get.
+    """
+    org_lists = []
+    for (org, versioned) in zip(orgs, org_repos):
+        if versioned and versioned[0]:
+            org_lists.append(repo_list(user, versioned[0], versioned[1], org))
+        else:
+            org_lists.append(None)
+    return flask.render_template("index_logged_in.html", user=user,
+                                 repo_list=repo_list(user, *repos),
+                                 orgs=orgs, org_lists=org_lists)
+
+
 @app.route("/")
 @github.reauthorize
 @github.rate_limit
 def index():
     if "g" in flask.session:
-        user = github.current_user()
+        # These calls are independent, so make them all at once - and
+        # they all have to be done by the same deadline.
+        deadline = github.call_deadline()
+        user = github.submit(github.current_user)
+        repos = github.submit(github.versioned_repos)
+        orgs = github.submit(github.versioned_orgs)
+        try:
+            orgs, orgs_version = github.result(orgs, deadline)
+            org_repos = github.gather([github.submit(github.versioned_repos,
+                                                     org["login"])
+                                       for org in orgs], deadline)
+            user = github.result(user, deadline)
+            repos = github.result(repos, deadline)
+        except pool.Timeout:
+            # We can't show anything without these. Org repos we can
+            # do without, see `gather`.
+            return flask.render_template("slow.html"), 503
         flask.session["e"] = user["email"]
-        orgs = github.orgs()
-        org_repos = [github.repos(org=org["login"]) for org in orgs]
-        return flask.render_template("index_logged_in.html",
-                                     user=user,
-                                     repos=github.repos(),
-                                     orgs=orgs, org_repos=org_repos)
+        tag = etag("index", user["login"], github.user_version(), repos[1],
+                   orgs_version, *[r is None and "failed" or r[1]
+                                   for r in org_repos])
+        return conditional(tag, lambda: render_index(user, repos, orgs,
+                                                     org_repos))
     return flask.render_template("index.html", auth_url=github.auth_url())
 
 
@@ -165,10 +277,18 @@ def repo_page(name, org=None):
     existing_own = list(db.existing_own(name, user["login"]))
     existing_not_own = list(db.existing_not_own(name, user["login"]))
 
-    return flask.render_template("repo.html", repo=repo, org=org,
-                                 existing_own=existing_own,
-                                 existing_not_own=existing_not_own,
-                                 **gen_xsrf(["create"]))
+    # The form's XSRF token is signed with the session's access token.
+    tag = etag("repo", user["login"], github.token_scope(flask.session["g"]),
+               github.user_version(),
+               github.versioned_repos(org and org["login"])[1],
+               [l["group_id"] for l in existing_own],
+               [(l["group_id"], l["username"]) for l in existing_not_own],
+               int(time.time() // XSRF_BUCKET))
+    return conditional(tag, lambda: flask.render_template(
+            "repo.html", repo=repo, org=org,
+            existing_own=existing_own,
+            existing_not_own=existing_not_own,
+            **gen_xsrf(["create"])))
 
 
 @app.route("/repo/<name>")
@@ -194,36 +314,83 @@ def org_repo(org_handle, name):
     return flask.abort(404, "No matching org")
 
 
-def repo_create(name, org=None):
+def audience_pages(user, username, name, org=None, cursors=None,
+                   private=True):
+    """Yield (source, cursor, usernames) for each page of everybody we
+    should invite to the list for `username`/`name` (a `private` repo,
+    or not).
+
+    A source's cursor is the next page to fetch from it, or 0 once it's
+    done. We start from `cursors`, as {source: cursor}.
+    """
+    cursors = cursors or {}
+    skip = set([user["login"], "invalid-email-address"])
+    sources = github.audience_sources(username, name, org and org["login"],
+                                      private)
+    for (source, path, field, memoize, shared) in sources:
+        start = cursors.get(source, 1)
+        if not start:
+            continue
+        for (page, logins) in github.pages(path, memoize, field, start,
+                                           github.PAGE_WORKERS, shared):
+            yield source, page + 1, [l for l in logins if l not in skip]
+        yield source, 0, []
+
+
+def repo_create(job, name, org=None):
+    """Create the list for `job`, picking up wherever it left off.
+
+    Invites are queued page by page as we find the audience, held under
+    the job's id until the list exists.
+    """
+    job_id = job["_id"]
     user = github.current_user()
     repo = repo_data(name, org and org["login"])
 
     if not repo:
-        return flask.abort(404, "No matching repo")
+        raise errors.JobFailed("No matching repo")
 
     username = org and org["login"] or user["login"]
-
-    to_invite = set()
-    to_invite.update(github.collaborators(username, name))
-    to_invite.update(github.contributors(username, name))
-    if org:
-        to_invite.update(github.members(org["login"]))
-    to_invite.update(github.forkers(username, name))
-    to_invite.update(github.watchers(username, name))
-    to_invite -= set([user["login"], "invalid-email-address"])
-
-    description = repo["description"]
-    group = fiesta_api.create_group(default_name=repo["name"],
-                                    description=description)
-
-    # Gitlists are public, archived and have the repo name as a subject-prefix
-    group.add_application("public", group_name=repo["name"])
-    group.add_application("subject_prefix", prefix=repo["name"])
-    group.add_application("archive")
-
     github_url = "https://github.com/%s/%s" % (username, repo["name"])
-    welcome_message = {"subject": "Welcome to %s@gitlists.com" % repo["name"],
-                       "markdown": """
+
+    held_since = job.get("held_since")
+    if held_since is None or held_since < time.time() - REGATHER_AFTER:
+        db.drop_held_invites(job_id)
+        job.update(cursors={}, audience=None, held_since=time.time())
+        db.renew_job(job, JOB_LEASE, cursors={}, audience=None,
+                     held_since=job["held_since"])
+
+    if job.get("audience") is None:
+        for (source, cursor, usernames) in \
+                audience_pages(user, username, name, org, job.get("cursors"),
+                               repo.get("private", True)):
+            db.renew_job(job, JOB_LEASE)
+            db.pending_invites(repo["name"], github_url, user["login"],
+                               usernames, job_id, held=True)
+            db.renew_job(job, JOB_LEASE, **{"cursors." + source: cursor})
+        job["audience"] = db.held_invites(job_id)
+        db.renew_job(job, JOB_LEASE, audience=job["audience"])
+
+    if job.get("group_id"):
+        group = worker.fiesta_group(job["group_id"])
+    else:
+        db.renew_job(job, FIESTA_LEASE)
+        description = repo["description"]
+        with metrics.timed("fiesta_seconds", call="create_group"):
+            group = fiesta_api.create_group(default_name=repo["name"],
+                                            description=description)
+
+            # Gitlists are public, archived and have the repo name as a
+            # subject-prefix
+            group.add_application("public", group_name=repo["name"])
+            group.add_application("subject_prefix", prefix=repo["name"])
+            group.add_application("archive")
+        db.renew_job(job, JOB_LEASE, group_id=group.id)
+
+    if not job.get("welcomed"):
+        subject = "Welcome to %s@gitlists.com" % repo["name"]
+        welcome_message = {"subject": subject,
+                           "markdown": """
 Your [Gitlist](https://gitlists.com) for [%s](%s) has been created.
 
 The [list page](https://fiesta.cc/list/%s) is the archive *and* where new members will need to go to join the list, so you might want to add it to your repo's README.
@@ -232,42 +399,145 @@ If you have any questions, send us an email at support@corp.fiesta.cc.
 
 Have a great day!
 """ % (repo["name"], github_url, group.id)}
-    group.add_member(user["email"],
-                     display_name=user.get("name", ""),
-                     welcome_message=welcome_message)
+        db.renew_job(job, FIESTA_LEASE)
+        with metrics.timed("fiesta_seconds", call="add_member"):
+            group.add_member(user["email"],
+                             display_name=user.get("name", ""),
+                             welcome_message=welcome_message)
+        db.renew_job(job, JOB_LEASE, welcomed=True)
 
-    for username in to_invite:
-        db.pending_invite(repo["name"], github_url, user["login"],
-                          username, group.id)
+    db.release_invites(job_id, group.id, worker.COALESCE_WINDOW)
+    worker.wake_invites()
 
     db.new_list(repo["name"], user["login"], group.id)
-    flask.flash("Your Gitlist has been created - check your email at '%s'." % user["email"])
-    return flask.redirect("/")
+    db.renew_job(job, 0, invites=job["audience"], email=user["email"],
+                 status="done")
+
+
+def run_job(job_id, name, org_handle=None):
+    """Create a list in the background, recording progress as we go.
+
+    Does nothing if somebody else is already running the job, and stops
+    (without touching the job) if somebody else takes it over.
+    """
+    job = db.claim_job(job_id, JOB_LEASE)
+    if not job:
+        return
+    try:
+        org = None
+        if org_handle:
+            for o in github.orgs():
+                if o["login"] == org_handle:
+                    org = o
+                    break
+            if not org:
+                raise errors.JobFailed("No matching org")
+        repo_create(job, name, org)
+        return
+    except errors.JobLost:
+        logging.warning("Lost job %s to somebody else" % job_id)
+        return
+    except errors.JobFailed, e:
+        error = str(e)
+    except github.RateLimited:
+        error = ("We've hit the GitHub API rate limit, "
+                 "please try again in a bit.")
+    except github.Reauthorize:
+        error = "GitHub wants you to log in again."
+    except Exception:
+        logging.exception("Job %s failed" % job_id)
+        error = "Something went wrong, we're looking into it."
+    try:
+        db.renew_job(job, 0, status="failed", error=error)
+    except errors.JobLost:
+        logging.warning("Lost job %s to somebody else" % job_id)
+
+
+def start_job(name, org_handle=None):
+    """Start a job creating a list, or retry the last one that didn't
+    finish.
+    """
+    owner = github.token_scope(flask.session["g"])
+    job = db.unfinished_job(owner, name, org_handle)
+    if job:
+        job_id = job["_id"]
+        db.retry_job(job_id)
+    else:
+        job_id = db.new_job(owner, repo=name, org=org_handle)
+    job_pool.submit(github.bound(run_job), job_id, name, org_handle)
+    return flask.redirect("/job/%s" % job_id)
 
 
 @app.route("/repo/<name>", methods=["POST"])
-@github.rate_limit
 @github.authorized
 @check_xsrf("create")
 def create_repo(name):
     if "g" not in flask.session:
         return flask.abort(403, "No user")
-    return repo_create(name)
+    return start_job(name)
 
 
 @app.route("/repo/<org_handle>/<name>", methods=["POST"])
-@github.rate_limit
 @github.authorized
 @check_xsrf("create")
 def create_org_repo(org_handle, name):
     if "g" not in flask.session:
         return flask.abort(403, "No user")
+    return start_job(name, org_handle)
 
-    for org in github.orgs():
-        if org["login"] == org_handle:
-            return repo_create(name, org)
 
-    return flask.abort(404, "No matching org")
+def own_job(job_id):
+    job = db.job(job_id)
+    if not job or job["owner"] != github.token_scope(flask.session["g"]):
+        return flask.abort(404, "No matching job")
+    # A running job whose lease is up was interrupted, pick it back up.
+    # So was a queued one if the process it was queued in died before
+    # getting to it. If it's still alive, claim_job makes our run a
+    # no-op.
+    if job["status"] == "queued" or \
+            (job["status"] == "running" and job.get("lease", 0) < time.time()):
+        job_pool.submit(github.bound(run_job), job_id, job["repo"],
+                        job.get("org"))
+    return job
+
+
+@app.route("/job/<job_id>")
+@github.authorized
+def job(job_id):
+    return flask.render_template("job.html", job=own_job(job_id))
+
+
+@app.route("/job/<job_id>.json")
+@github.authorized
+def job_json(job_id):
+    job = own_job(job_id)
+    return flask.jsonify(status=job["status"],
+                         audience=job.get("audience"),
+                         group_id=job.get("group_id"),
+                         invites=job.get("invites"),
+                         error=job.get("error"))
+
+
+def memo_hit_ratio():
+    """How many memo lookups were hits, in either tier.
+    """
+    lookups = db.memo_cache.stats["hits"] + db.memo_cache.stats["misses"]
+    if not lookups:
+        return None
+    return (db.memo_cache.stats["hits"] + db.memo_stats["hits"]) / \
+        float(lookups)
+
+
+metrics.gauge("memo_hit_ratio", memo_hit_ratio)
+
+
+@app.route("/metrics")
+def get_metrics():
+    labels = {}
+    if worker_number is not None:
+        labels["worker"] = worker_number
+    return flask.Response(metrics.render(**labels),
+                          content_type=metrics.CONTENT_TYPE)
 
 
 @app.route("/auth/github")
@@ -288,14 +558,50 @@ def get_error():
     raise Exception("error")
 
 
+def serve(server, number):
+    """Serve requests from `server` as worker `number`, until SIGTERM.
+
+    Then we finish what we're doing (for up to DRAIN_TIMEOUT seconds).
+    """
+    global invite_threads, worker_number
+    invite_threads = invite_threads and number == 0
+    worker_number = number
+    listener = None
+    if getattr(settings, "metrics_port", None) is not None:
+        listener = metrics.serve(settings.metrics_port + number,
+                                 process="www", worker=number)
+    if invite_threads:
+        worker.start()
+    server.serve_until_stopped()
+
+    # Our replacement wants our metrics port.
+    if listener:
+        listener.stop()
+    deadline = time.time() + DRAIN_TIMEOUT
+    left = lambda: max(0, deadline - time.time())
+    if invite_threads:
+        worker.stop()
+    drained = server.drain(left())
+    drained = job_pool.join(left()) and drained
+    if invite_threads:
+        drained = worker.join(left()) and drained
+    if not drained:
+        logging.error("Worker %d stopped before it was done" % number)
+
+
 class GitlistsDaemon(daemon.Daemon):
+    graceful = True
+
     def __init__(self, port, *args, **kwargs):
         self.port = port
         return daemon.Daemon.__init__(self, *args, **kwargs)
 
     def run(self):
         db.create_indexes()
-        app.run(host=settings.host, port=self.port)
+        server = daemon.PooledWSGIServer(settings.host, self.port, app,
+                                         THREADS, daemon.inherited_fd())
+        daemon.Prefork(WORKERS, lambda n: serve(server, n), DRAIN_TIMEOUT,
+                       server.fileno(), self.argv).run()
 
 
 if __name__ == '__main__':